@@ -0,0 +1,194 @@
+import json
+import time
+import uuid
+import sqlite3
+import numpy as np
+from langchain.schema import Document
+
+def _get_answers_db(analytiq_config: dict) -> sqlite3.Connection:
+    """
+    Open the answer cache, kept in analytiq_answers.db in the docstore.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+
+    Returns:
+        sqlite3.Connection: A connection to the answer cache.
+    """
+    conn = sqlite3.connect(f"{analytiq_config['docstore']}/analytiq_answers.db", timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS answers (
+            answer_id TEXT PRIMARY KEY,
+            collection_name TEXT NOT NULL,
+            filter_key TEXT NOT NULL,
+            model TEXT NOT NULL,
+            question TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            answer TEXT NOT NULL,
+            refs TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS answer_files (
+            answer_id TEXT NOT NULL REFERENCES answers (answer_id) ON DELETE CASCADE,
+            uuid TEXT NOT NULL,
+            PRIMARY KEY (answer_id, uuid)
+        );
+        CREATE INDEX IF NOT EXISTS answers_key ON answers (collection_name, filter_key, model);
+        CREATE INDEX IF NOT EXISTS answer_files_uuid ON answer_files (uuid);
+    """)
+    return conn
+
+def get_answer_filter_key(doc_types: list = [], doc_years: list = []) -> str:
+    """
+    Get the cache key of the Chat document type and year selections.
+    """
+    return json.dumps({"type": sorted(str(value) for value in doc_types),
+                       "year": sorted(str(value) for value in doc_years)})
+
+def get_cached_answer(analytiq_config: dict,
+                      collection_name: str,
+                      filter_key: str,
+                      model: str,
+                      question_embedding: np.ndarray) -> dict:
+    """
+    Get the cached answer to the question most similar to a condensed question.
+
+    Only answers from the same collection, filters and model, younger than the TTL and
+    more similar than the threshold are returned.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        filter_key (str): The cache key of the document type and year selections.
+        model (str): The chat model.
+        question_embedding (np.ndarray): The embedding of the condensed question.
+
+    Returns:
+        dict: The "question", "answer" and "references" of the cached answer, or None on a miss.
+    """
+    ttl = analytiq_config.get("answer_cache_ttl", 0)
+    if ttl <= 0:
+        return None
+
+    conn = _get_answers_db(analytiq_config)
+    rows = conn.execute("""SELECT question, embedding, answer, refs FROM answers
+                           WHERE collection_name = ? AND filter_key = ? AND model = ? AND created_at > ?""",
+                        (collection_name, filter_key, model, time.time() - ttl)).fetchall()
+    conn.close()
+    if len(rows) == 0:
+        return None
+
+    # Cosine similarity between the question and the cached questions
+    embeddings = np.stack([np.frombuffer(row["embedding"], dtype=np.float32) for row in rows])
+    query = np.asarray(question_embedding, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query)
+    similarities = embeddings @ query / np.maximum(norms, 1e-12)
+
+    best = int(np.argmax(similarities))
+    if similarities[best] < analytiq_config.get("answer_cache_threshold", 0.95):
+        return None
+
+    row = rows[best]
+    return {
+        "question": row["question"],
+        "answer": row["answer"],
+        "references": [Document(page_content=ref["page_content"], metadata=ref["metadata"])
+                       for ref in json.loads(row["refs"])]
+    }
+
+def save_cached_answer(analytiq_config: dict,
+                       collection_name: str,
+                       filter_key: str,
+                       model: str,
+                       question: str,
+                       question_embedding: np.ndarray,
+                       answer: str,
+                       references: list) -> None:
+    """
+    Cache the answer to a condensed question, and drop the expired answers.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        filter_key (str): The cache key of the document type and year selections.
+        model (str): The chat model.
+        question (str): The condensed question.
+        question_embedding (np.ndarray): The embedding of the condensed question.
+        answer (str): The answer.
+        references (list): The langchain Documents the answer is based on.
+    """
+    ttl = analytiq_config.get("answer_cache_ttl", 0)
+    if ttl <= 0:
+        return
+
+    answer_id = str(uuid.uuid4())
+    now = time.time()
+    refs = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in references]
+    with _get_answers_db(analytiq_config) as conn:
+        conn.execute("DELETE FROM answers WHERE created_at <= ?", (now - ttl,))
+        conn.execute("""INSERT INTO answers (answer_id, collection_name, filter_key, model, question, embedding, answer, refs, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (answer_id, collection_name, filter_key, model, question,
+                      np.asarray(question_embedding, dtype=np.float32).tobytes(),
+                      answer, json.dumps(refs), now))
+        conn.executemany("INSERT OR IGNORE INTO answer_files (answer_id, uuid) VALUES (?, ?)",
+                         [(answer_id, doc.metadata["uuid"]) for doc in references])
+    conn.close()
+
+def invalidate_cached_answers(analytiq_config: dict,
+                              collection_name: str,
+                              file_uuids: list = None) -> None:
+    """
+    Drop the cached answers of a collection that reference files whose chunks changed.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        file_uuids (list, optional): The uuids of the changed files. Drops all the answers
+            of the collection if None. Defaults to None.
+    """
+    with _get_answers_db(analytiq_config) as conn:
+        if file_uuids is None:
+            conn.execute("DELETE FROM answers WHERE collection_name = ?", (collection_name,))
+        else:
+            file_uuids = list(file_uuids)
+            for i in range(0, len(file_uuids), 500):
+                batch = file_uuids[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                conn.execute(f"""DELETE FROM answers WHERE collection_name = ? AND answer_id IN
+                                 (SELECT answer_id FROM answer_files WHERE uuid IN ({placeholders}))""",
+                             [collection_name] + batch)
+    conn.close()
+
+def invalidate_recategorized_answers(analytiq_config: dict,
+                                     collection_name: str,
+                                     file_manifest: dict,
+                                     file_manifest_orig: dict) -> None:
+    """
+    Drop the cached answers of a collection that a change of a file's type or year affects:
+    the answers referencing the file, and the answers whose type and year selections
+    now select the file and did not, or the other way round.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        file_manifest (dict): The file manifest, with the new type and year.
+        file_manifest_orig (dict): The file manifest, with the previous type and year.
+    """
+    def selects(filters: dict, doc: dict) -> bool:
+        return all(len(filters[field]) == 0 or str(doc[field]) in filters[field] for field in ["type", "year"])
+
+    with _get_answers_db(analytiq_config) as conn:
+        rows = conn.execute("SELECT answer_id, filter_key FROM answers WHERE collection_name = ?",
+                            (collection_name,)).fetchall()
+        answer_ids = [row["answer_id"] for row in rows
+                      if selects(json.loads(row["filter_key"]), file_manifest)
+                         != selects(json.loads(row["filter_key"]), file_manifest_orig)]
+        conn.executemany("DELETE FROM answers WHERE answer_id = ?", [(answer_id,) for answer_id in answer_ids])
+        conn.execute("""DELETE FROM answers WHERE collection_name = ? AND answer_id IN
+                        (SELECT answer_id FROM answer_files WHERE uuid = ?)""",
+                     (collection_name, file_manifest["uuid"]))
+    conn.close()
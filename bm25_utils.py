@@ -0,0 +1,273 @@
+import re
+import math
+import time
+import sqlite3
+from collections import Counter
+
+# BM25 parameters
+bm25_k1 = 1.5
+bm25_b = 0.75
+
+# Common words that carry no weight in a keyword search
+bm25_stopwords = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have",
+    "in", "is", "it", "its", "of", "on", "or", "that", "the", "this", "to", "was",
+    "were", "what", "when", "where", "which", "who", "will", "with",
+}
+
+def tokenize(text: str) -> list:
+    """
+    Split a text into lowercase search terms.
+
+    Dotted and dashed numbers such as article numbers (12.3, 2023-14) are kept as single terms.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list: The terms, in text order.
+    """
+    terms = re.findall(r"\w+(?:[.\-]\w+)*", text.lower())
+    return [term for term in terms if term not in bm25_stopwords]
+
+def _get_bm25_db(analytiq_config: dict) -> sqlite3.Connection:
+    """
+    Open the keyword index, kept in analytiq_bm25.db in the docstore.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+
+    Returns:
+        sqlite3.Connection: A connection to the keyword index.
+    """
+    conn = sqlite3.connect(f"{analytiq_config['docstore']}/analytiq_bm25.db", timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS collections (
+            collection_name TEXT PRIMARY KEY,
+            built_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chunks (
+            collection_name TEXT NOT NULL,
+            chunk_id TEXT NOT NULL,
+            uuid TEXT NOT NULL,
+            type TEXT,
+            year TEXT,
+            length INTEGER NOT NULL,
+            PRIMARY KEY (collection_name, chunk_id)
+        );
+        CREATE TABLE IF NOT EXISTS postings (
+            collection_name TEXT NOT NULL,
+            term TEXT NOT NULL,
+            chunk_id TEXT NOT NULL,
+            tf INTEGER NOT NULL,
+            PRIMARY KEY (collection_name, term, chunk_id)
+        );
+        CREATE INDEX IF NOT EXISTS chunks_uuid ON chunks (collection_name, uuid);
+        CREATE INDEX IF NOT EXISTS postings_chunk ON postings (collection_name, chunk_id);
+    """)
+    return conn
+
+def _insert_bm25_chunks(conn: sqlite3.Connection,
+                        collection_name: str,
+                        ids: list,
+                        metadatas: list,
+                        documents: list) -> None:
+    for chunk_id, metadata, document in zip(ids, metadatas, documents):
+        term_counts = Counter(tokenize(document))
+        conn.execute("INSERT OR REPLACE INTO chunks (collection_name, chunk_id, uuid, type, year, length) VALUES (?, ?, ?, ?, ?, ?)",
+                     (collection_name, chunk_id, metadata["uuid"], metadata.get("type"), metadata.get("year"),
+                      sum(term_counts.values())))
+        conn.executemany("INSERT OR REPLACE INTO postings (collection_name, term, chunk_id, tf) VALUES (?, ?, ?, ?)",
+                         [(collection_name, term, chunk_id, tf) for term, tf in term_counts.items()])
+
+def add_bm25_chunks(analytiq_config: dict,
+                    collection_name: str,
+                    ids: list,
+                    metadatas: list,
+                    documents: list) -> None:
+    """
+    Add chunks to the keyword index of a collection.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        ids (list): The Chroma ids of the chunks.
+        metadatas (list): The chunk metadatas, with the file uuid, type and year.
+        documents (list): The chunk texts.
+    """
+    with _get_bm25_db(analytiq_config) as conn:
+        _insert_bm25_chunks(conn, collection_name, ids, metadatas, documents)
+    conn.close()
+
+def delete_bm25_file(analytiq_config: dict, collection_name: str, file_uuid: str) -> None:
+    """
+    Delete the chunks of a file from the keyword index of a collection.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        file_uuid (str): The file uuid.
+    """
+    with _get_bm25_db(analytiq_config) as conn:
+        conn.execute("""DELETE FROM postings WHERE collection_name = ? AND chunk_id IN
+                        (SELECT chunk_id FROM chunks WHERE collection_name = ? AND uuid = ?)""",
+                     (collection_name, collection_name, file_uuid))
+        conn.execute("DELETE FROM chunks WHERE collection_name = ? AND uuid = ?",
+                     (collection_name, file_uuid))
+    conn.close()
+
+def update_bm25_file(analytiq_config: dict, collection_name: str, file_manifest: dict) -> None:
+    """
+    Update the type and year of the chunks of a file in the keyword index of a collection.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        file_manifest (dict): The file manifest, with the file uuid, type and year.
+    """
+    with _get_bm25_db(analytiq_config) as conn:
+        conn.execute("UPDATE chunks SET type = ?, year = ? WHERE collection_name = ? AND uuid = ?",
+                     (file_manifest["type"], file_manifest["year"], collection_name, file_manifest["uuid"]))
+    conn.close()
+
+def delete_bm25_chunks(analytiq_config: dict, collection_name: str, ids: list) -> None:
+    """
+    Delete chunks from the keyword index of a collection.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        ids (list): The Chroma ids of the chunks.
+    """
+    with _get_bm25_db(analytiq_config) as conn:
+        conn.executemany("DELETE FROM postings WHERE collection_name = ? AND chunk_id = ?",
+                         [(collection_name, chunk_id) for chunk_id in ids])
+        conn.executemany("DELETE FROM chunks WHERE collection_name = ? AND chunk_id = ?",
+                         [(collection_name, chunk_id) for chunk_id in ids])
+    conn.close()
+
+def clear_bm25_collection(analytiq_config: dict, collection_name: str) -> None:
+    """
+    Empty the keyword index of a collection. The empty index counts as built.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+    """
+    with _get_bm25_db(analytiq_config) as conn:
+        conn.execute("DELETE FROM postings WHERE collection_name = ?", (collection_name,))
+        conn.execute("DELETE FROM chunks WHERE collection_name = ?", (collection_name,))
+        conn.execute("INSERT OR REPLACE INTO collections (collection_name, built_at) VALUES (?, ?)",
+                     (collection_name, time.time()))
+    conn.close()
+
+def check_bm25_index(analytiq_config: dict, collection_name: str) -> bool:
+    """
+    Return True if the keyword index of the collection has been built.
+    """
+    conn = _get_bm25_db(analytiq_config)
+    row = conn.execute("SELECT 1 FROM collections WHERE collection_name = ?", (collection_name,)).fetchone()
+    conn.close()
+    return row is not None
+
+def rebuild_bm25_index(analytiq_config: dict, collection_name: str, chroma_collection) -> int:
+    """
+    Rebuild the keyword index of a collection from a paged scan of its Chroma chunks.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        chroma_collection: The Chroma collection.
+
+    Returns:
+        int: The number of chunks indexed.
+    """
+    conn = _get_bm25_db(analytiq_config)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM postings WHERE collection_name = ?", (collection_name,))
+        conn.execute("DELETE FROM chunks WHERE collection_name = ?", (collection_name,))
+
+        n_chunks = 0
+        offset = 0
+        while True:
+            result = chroma_collection.get(limit=1000, offset=offset, include=["metadatas", "documents"])
+            result_size = len(result["ids"])
+            if result_size == 0:
+                break
+            offset += result_size
+            _insert_bm25_chunks(conn, collection_name, result["ids"], result["metadatas"], result["documents"])
+            n_chunks += result_size
+
+        conn.execute("INSERT OR REPLACE INTO collections (collection_name, built_at) VALUES (?, ?)",
+                     (collection_name, time.time()))
+        conn.execute("COMMIT")
+    except:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    return n_chunks
+
+def search_bm25(analytiq_config: dict,
+                collection_name: str,
+                query: str,
+                k: int = 10,
+                doc_types: list = [],
+                doc_years: list = []) -> list:
+    """
+    Search the keyword index of a collection with BM25.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        query (str): The query text.
+        k (int, optional): The number of chunks to return. Defaults to 10.
+        doc_types (list, optional): Only search chunks of documents of these types. Defaults to all types.
+        doc_years (list, optional): Only search chunks of documents of these years. Defaults to all years.
+
+    Returns:
+        list: (chunk id, score) pairs, best first.
+    """
+    terms = set(tokenize(query))
+    if len(terms) == 0:
+        return []
+
+    # Restrict the postings to the selected document types and years
+    chunk_filter = ""
+    filter_params = []
+    for field, values in [("type", doc_types), ("year", doc_years)]:
+        if len(values) > 0:
+            chunk_filter += f" AND c.{field} IN ({','.join('?' * len(values))})"
+            filter_params += list(values)
+
+    conn = _get_bm25_db(analytiq_config)
+    n_chunks, avg_length = conn.execute("SELECT COUNT(*), AVG(length) FROM chunks WHERE collection_name = ?",
+                                        (collection_name,)).fetchone()
+    if n_chunks == 0:
+        conn.close()
+        return []
+    avg_length = max(avg_length, 1)
+
+    scores = Counter()
+    for term in terms:
+        df = conn.execute("SELECT COUNT(*) FROM postings WHERE collection_name = ? AND term = ?",
+                          (collection_name, term)).fetchone()[0]
+        if df == 0:
+            continue
+        idf = math.log(1 + (n_chunks - df + 0.5) / (df + 0.5))
+
+        rows = conn.execute(f"""SELECT p.chunk_id, p.tf, c.length FROM postings p
+                                JOIN chunks c ON c.collection_name = p.collection_name AND c.chunk_id = p.chunk_id
+                                WHERE p.collection_name = ? AND p.term = ?{chunk_filter}""",
+                            [collection_name, term] + filter_params)
+        for chunk_id, tf, length in rows:
+            norm = tf + bm25_k1 * (1 - bm25_b + bm25_b * length / avg_length)
+            scores[chunk_id] += idf * tf * (bm25_k1 + 1) / norm
+    conn.close()
+
+    return scores.most_common(k)
@@ -0,0 +1,255 @@
+import queue
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain.chains import LLMChain
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.chains.question_answering import load_qa_chain
+from langchain.chat_models import ChatOpenAI
+from langchain.callbacks import get_openai_callback
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.schema import Document, get_buffer_string
+
+from utils import (
+    SessionRateLimiter
+)
+from collection_utils import (
+    cl100k_base_length_function,
+    cl100k_base_truncate
+)
+from embedding_utils import (
+    embed_query
+)
+from answer_cache_utils import (
+    get_cached_answer,
+    save_cached_answer
+)
+
+# Process-wide chat services, one per docstore
+_chat_services = {}
+_chat_services_lock = threading.Lock()
+
+async def acondense_question(llm, question: str, chat_history: list) -> str:
+    """
+    Rephrase a follow-up question as a standalone question, as ConversationalRetrievalChain does.
+
+    Args:
+        llm: The chat model rephrasing the question.
+        question (str): The user question.
+        chat_history (list): The chat history messages.
+
+    Returns:
+        str: The standalone question, or the question itself when there is no history.
+    """
+    if len(chat_history) == 0:
+        return question
+
+    question_generator = LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT)
+    return await question_generator.arun(question=question, chat_history=get_buffer_string(chat_history))
+
+# Max tokens of retrieved context per model
+model_chunk_size = {
+    "gpt-3.5-turbo": 1500,
+    "gpt-3.5-turbo-16k": 6000, 
+    "gpt-4": 3000, 
+    "gpt-4-32k": 32000,
+}
+
+# Context window of each model, in tokens
+model_context_window = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+
+# Tokens reserved for the answer, and for the QA prompt template around the context
+answer_tokens = 1000
+prompt_tokens = 200
+
+def get_context_budget(model: str, prompt_text: str = "") -> int:
+    """
+    Get the number of tokens of retrieved context the model can take with a prompt.
+
+    Args:
+        model (str): The chat model.
+        prompt_text (str, optional): The question and chat history sent along with the context. Defaults to "".
+
+    Returns:
+        int: The context budget in tokens.
+    """
+    available = (model_context_window[model] - answer_tokens - prompt_tokens
+                 - cl100k_base_length_function(prompt_text))
+    return max(min(model_chunk_size[model], available), 0)
+
+def pack_context(documents: list, max_tokens: int, min_trim_tokens: int = 100) -> list:
+    """
+    Fit retrieved chunks into a token budget, best first.
+
+    Repeated chunks are dropped. The first chunk that does not fit is trimmed to the
+    remaining budget, unless less than min_trim_tokens remain.
+
+    Args:
+        documents (list): The langchain Documents, best first.
+        max_tokens (int): The token budget.
+        min_trim_tokens (int, optional): The smallest useful trimmed chunk. Defaults to 100.
+
+    Returns:
+        list: The Documents that fit.
+    """
+    packed = []
+    seen = set()
+    remaining = max_tokens
+    for doc in documents:
+        text = " ".join(doc.page_content.split())
+        if text in seen:
+            continue
+        seen.add(text)
+
+        n_tokens = cl100k_base_length_function(doc.page_content) + 2  # Chunk separator
+        if n_tokens <= remaining:
+            packed.append(doc)
+            remaining -= n_tokens
+        else:
+            if remaining >= min_trim_tokens:
+                packed.append(Document(page_content=cl100k_base_truncate(doc.page_content, remaining - 2),
+                                       metadata=doc.metadata))
+            break
+
+    return packed
+
+class _QueueStreamHandler(AsyncCallbackHandler):
+    """
+    Forward the streamed answer tokens to the event queue of a chat request.
+    """
+    def __init__(self, events: queue.Queue):
+        self.events = events
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.events.put({"type": "token", "token": token})
+
+class ChatService:
+    """
+    Asyncio chat backend shared by the Chat page sessions of the process.
+
+    Requests run on an event loop in a background thread. Retrieval and reranking run in a
+    thread pool and the answers stream through the async OpenAI client, so concurrent sessions
+    do not wait on each other. Each session is rate limited separately.
+    """
+    def __init__(self, analytiq_config: dict):
+        self.analytiq_config = analytiq_config
+        self.rate_limiter = SessionRateLimiter(interval=60 / analytiq_config.get("chat_rate_per_minute", 10),
+                                               burst=analytiq_config.get("chat_rate_burst", 3))
+        self._concurrency = analytiq_config.get("chat_concurrency", 16)
+        self._llm_slots = None
+
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(ThreadPoolExecutor(max_workers=self._concurrency,
+                                                           thread_name_prefix="analytiq-chat"))
+        threading.Thread(target=self._loop.run_forever, name="analytiq-chat-loop", daemon=True).start()
+
+    def ask(self,
+            session_id: str,
+            retriever,
+            collection_name: str,
+            filter_key: str,
+            model: str,
+            question: str,
+            chat_history: list):
+        """
+        Answer a chat question, streaming the answer as it is generated.
+
+        Args:
+            session_id (str): The id of the user session, for rate limiting.
+            retriever (AnalytiqHybridRetriever): The retriever of the collection.
+            collection_name (str): The name of the collection.
+            filter_key (str): The answer cache key of the document type and year selections.
+            model (str): The chat model.
+            question (str): The user question.
+            chat_history (list): The chat history messages.
+
+        Yields:
+            dict: The events of the request: {"type": "references", "documents": [...]},
+                {"type": "token", "token": ...}, {"type": "answer", "answer": ..., "cached": bool}
+                or {"type": "error", "error": ...}.
+        """
+        if not self.rate_limiter.acquire(session_id):
+            yield {"type": "error",
+                   "error": "You are sending requests too fast. Please wait a few seconds before sending another request."}
+            return
+
+        events = queue.Queue()
+        asyncio.run_coroutine_threadsafe(self._answer(events, retriever, collection_name, filter_key,
+                                                      model, question, chat_history),
+                                         self._loop)
+        while True:
+            event = events.get()
+            if event["type"] == "done":
+                return
+            yield event
+
+    async def _answer(self,
+                      events: queue.Queue,
+                      retriever,
+                      collection_name: str,
+                      filter_key: str,
+                      model: str,
+                      question: str,
+                      chat_history: list) -> None:
+        loop = asyncio.get_running_loop()
+        if self._llm_slots is None:
+            self._llm_slots = asyncio.Semaphore(self._concurrency)
+
+        try:
+            # Condense the question with the chat history
+            question = await acondense_question(ChatOpenAI(model_name=model, temperature=0), question, chat_history)
+
+            # Reuse the answer to a similar question, if any
+            question_embedding = await loop.run_in_executor(None, embed_query, question, retriever.embedding,
+                                                            self.analytiq_config.get("query_cache_size", 1024))
+            cached_answer = await loop.run_in_executor(None, get_cached_answer, self.analytiq_config,
+                                                       collection_name, filter_key, model, question_embedding)
+            if cached_answer is not None:
+                events.put({"type": "references", "documents": cached_answer["references"]})
+                events.put({"type": "answer", "answer": cached_answer["answer"], "cached": True})
+                return
+
+            async with self._llm_slots:
+                # Fit the retrieved chunks into the model context, next to the question and the answer
+                request_retriever = retriever.copy(update={"max_tokens": get_context_budget(model, prompt_text=question)})
+                documents = await request_retriever.aget_relevant_documents(question)
+                events.put({"type": "references", "documents": documents})
+
+                qa_chain = load_qa_chain(ChatOpenAI(model_name=model, temperature=0, streaming=True),
+                                         chain_type="stuff")
+                with get_openai_callback() as cost:
+                    answer = await qa_chain.arun(input_documents=documents,
+                                                 question=question,
+                                                 callbacks=[_QueueStreamHandler(events)])
+                    print(cost)
+            events.put({"type": "answer", "answer": answer, "cached": False})
+
+            try:
+                await loop.run_in_executor(None, save_cached_answer, self.analytiq_config, collection_name,
+                                           filter_key, model, question, question_embedding, answer, documents)
+            except Exception as e:
+                print(f"Failed to cache the answer: {e}")
+        except Exception as e:
+            events.put({"type": "error", "error": str(e)})
+        finally:
+            events.put({"type": "done"})
+
+def get_chat_service(analytiq_config: dict) -> ChatService:
+    """
+    Get the shared chat service of the docstore, starting it on first use.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+
+    Returns:
+        ChatService: The chat service.
+    """
+    with _chat_services_lock:
+        if analytiq_config["docstore"] not in _chat_services:
+            _chat_services[analytiq_config["docstore"]] = ChatService(analytiq_config)
+        return _chat_services[analytiq_config["docstore"]]
@@ -1,18 +1,107 @@
 import os
+import json
+import time
+import threading
+import hashlib
 import chromadb
-import uuid
 from chromadb.config import Settings
-from langchain.vectorstores import Chroma
-from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
-from chromadb.utils import embedding_functions
+from langchain.schema import Document
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+from embedding_utils import (
+    AnalytiqEmbeddingFunction,
+    embed_chunks,
+    embed_query,
+    get_embedding_dimension
+)
+from bm25_utils import (
+    add_bm25_chunks,
+    delete_bm25_file,
+    delete_bm25_chunks,
+    update_bm25_file,
+    clear_bm25_collection
+)
+from answer_cache_utils import (
+    invalidate_cached_answers,
+    invalidate_recategorized_answers
+)
 
 
 import streamlit as st
 
+from config_utils import (
+    lock_manifest,
+    write_manifest
+)
+
+# Process-wide Chroma clients, one per server, shared by all sessions
+_chroma_clients = {}
+# Process-wide collection handles, keyed by server and collection name
+_chroma_collections = {}
+_chroma_lock = threading.RLock()
+
+# Seconds between health checks of a shared client, and heartbeat attempts per check
+chroma_health_interval = 30
+chroma_connect_retries = 3
+
+# Locks serializing the first connection to each server, so that other servers are not blocked
+_chroma_connect_locks = {}
+
+def _check_chroma_client(chroma_client) -> bool:
+    """
+    Return True if the Chroma server of a client answers a heartbeat, retrying with backoff.
+    """
+    for attempt in range(chroma_connect_retries):
+        try:
+            chroma_client.heartbeat()
+            return True
+        except Exception:
+            if attempt < chroma_connect_retries - 1:
+                time.sleep(0.5 * 2 ** attempt)
+    return False
+
+def _connect_chroma_client(analytiq_config: dict):
+    """
+    Create a Chroma client of the configured server.
+    """
+    return chromadb.HttpClient(host=analytiq_config["chroma_host"],
+                               port=analytiq_config["chroma_port"], 
+                               settings=Settings(allow_reset=True))
+
+def _refresh_chroma_client(analytiq_config: dict, entry: dict) -> None:
+    """
+    Health check the shared client of a server, in a background thread. If the server does not
+    answer, the client is replaced by a new connection once the server answers again.
+    """
+    server = (analytiq_config["chroma_host"], analytiq_config["chroma_port"])
+    try:
+        if _check_chroma_client(entry["client"]):
+            if entry["healthy"]:
+                return
+            # The server is back, maybe restarted. Reconnect, and drop the collection handles of the old client.
+            chroma_client = _connect_chroma_client(analytiq_config)
+            with _chroma_lock:
+                entry["client"] = chroma_client
+                entry["healthy"] = True
+                for key in [key for key in _chroma_collections if key[:2] == server]:
+                    del _chroma_collections[key]
+        else:
+            print(f"ChromaDB at {server[0]}:{server[1]} does not answer")
+            entry["healthy"] = False
+    finally:
+        with _chroma_lock:
+            entry["checked_at"] = time.monotonic()
+            entry["checking"] = False
+
 def get_chroma_client(analytiq_config: dict = {},
                       analytiq_collections: dict = {}):
     """
-    Get a ChromaDB client.
+    Get the shared ChromaDB client of the process.
+
+    The client is health checked in the background at most every chroma_health_interval seconds,
+    and reconnected when the server answers again after a failed check. The current client is
+    handed out meanwhile, so a slow server does not block the sessions of other servers, or
+    the callers that do not need the server.
 
     Args:
         analytiq_config (dict, optional): The ChromaDB configuration. Defaults to {}.
@@ -20,27 +109,48 @@ def get_chroma_client(analytiq_config: dict = {},
 
     Returns:
         ChromaDB client.
+
+    Raises:
+        ConnectionError: If the first connection to the Chroma server fails.
     """
-    if "chroma_client" not in st.session_state:
-        # Create the client
-        chroma_client = chromadb.HttpClient(host=analytiq_config["chroma_host"],
-                                            port=analytiq_config["chroma_port"], 
-                                            settings=Settings(allow_reset=True))
-        st.session_state.chroma_client = chroma_client
-
-    chroma_client = st.session_state.chroma_client
- 
-    # Get the list of collections
-    if "chroma_collections" not in st.session_state:
-        st.session_state.chroma_collections = {}
-    
+    server = (analytiq_config["chroma_host"], analytiq_config["chroma_port"])
+    with _chroma_lock:
+        entry = _chroma_clients.get(server)
+        connect_lock = _chroma_connect_locks.setdefault(server, threading.Lock())
+
+    if entry is None:
+        # Connect once per server, without holding the process-wide lock
+        with connect_lock:
+            entry = _chroma_clients.get(server)
+            if entry is None:
+                chroma_client = _connect_chroma_client(analytiq_config)
+                if not _check_chroma_client(chroma_client):
+                    raise ConnectionError(f"Cannot reach ChromaDB at {server[0]}:{server[1]}")
+                entry = {"client": chroma_client,
+                         "checked_at": time.monotonic(),
+                         "checking": False,
+                         "healthy": True}
+                with _chroma_lock:
+                    _chroma_clients[server] = entry
+
+    with _chroma_lock:
+        if not entry["checking"] and time.monotonic() - entry["checked_at"] > chroma_health_interval:
+            entry["checking"] = True
+            threading.Thread(target=_refresh_chroma_client,
+                             args=(analytiq_config, entry),
+                             name="chroma-health-check",
+                             daemon=True).start()
+        chroma_client = entry["client"]
+
+    # Ensure that the collection handles have been created
     for collection_name in analytiq_collections:
-        # Ensure that the collection handle has been created
-        if collection_name not in st.session_state.chroma_collections:
-            embedding_functions = analytiq_collections[collection_name]["embedding"]
+        if server + (collection_name,) not in _chroma_collections:
+            embedding_function = AnalytiqEmbeddingFunction(model_name=analytiq_collections[collection_name]["embedding"],
+                                                           batch_size=analytiq_config.get("embed_batch_size", 64))
             chroma_collection = chroma_client.get_or_create_collection(name=collection_name,
-                                                                       embedding_function=embedding_functions)
-            st.session_state.chroma_collections[collection_name] = chroma_collection
+                                                                       embedding_function=embedding_function)
+            with _chroma_lock:
+                _chroma_collections.setdefault(server + (collection_name,), chroma_collection)
 
     return chroma_client
 
@@ -48,45 +158,46 @@ def get_chroma_collection(analytiq_config: dict = {},
                           analytiq_collections: dict = {},
                           collection_name: str = "default"):
     """
-    Get a Chroma collection.
+    Get a Chroma collection, from the handles shared by all sessions.
 
     Args:
         analytiq_config (dict, optional): The ChromaDB configuration. Defaults to {}.
+        analytiq_collections (dict, optional): The collections configuration. Defaults to {}.
         collection_name (str, optional): The name of the collection. Defaults to "public_records".
-        embedding_function (str, optional): The name of the embedding function. Defaults to "all-MiniLM-L6-v2".
 
     Returns:
         ChromaDB collection.
     """
-    if "chroma_collection" not in st.session_state:
-        # Initialize the collections
-        st.session_state.chroma_collections = {}
-    
-    # Do we have the collection already?
-    if collection_name in st.session_state.chroma_collections:
-        return st.session_state.chroma_collections[collection_name]
+    # Get the client first, which schedules its health check
+    chroma_client = get_chroma_client(analytiq_config=analytiq_config)
 
-    # We will create the collection
+    key = (analytiq_config["chroma_host"], analytiq_config["chroma_port"], collection_name)
+    with _chroma_lock:
+        # Do we have the collection already?
+        if key in _chroma_collections:
+            return _chroma_collections[key]
 
-    # Create the client
-    chroma_client = get_chroma_client(analytiq_config=analytiq_config)
+    # Get the embedding function, which shares the process-wide embedding models
+    embedding = "all-MiniLM-L6-v2"
+    if collection_name in analytiq_collections:
+        embedding = analytiq_collections[collection_name]["embedding"]
+    embedding_function = AnalytiqEmbeddingFunction(model_name=embedding,
+                                                   batch_size=analytiq_config.get("embed_batch_size", 64))
 
-    # Does the collection exist?
+    # Does the collection exist? Ask the server outside the process-wide lock.
     try:
-        chroma_collection = chroma_client.get_collection(name=collection_name)
+        chroma_collection = chroma_client.get_collection(name=collection_name,
+                                                         embedding_function=embedding_function)
     except:
-        # Create the embedding function
-        embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-
         # Create the collection
-        chroma_collection = chroma_client.create_collection(name=collection_name,
-                                                            embedding_function=embedding_function)
+        chroma_collection = chroma_client.get_or_create_collection(name=collection_name,
+                                                                   embedding_function=embedding_function)
         
         st.success(f"Created chroma collection {collection_name}")
 
-    # Save the collection and return
-    st.session_state.chroma_collections[collection_name] = chroma_collection
-    return st.session_state.chroma_collections[collection_name]
+    # Save the collection and return, unless another session saved it first
+    with _chroma_lock:
+        return _chroma_collections.setdefault(key, chroma_collection)
 
 def delete_chroma_collection(analytiq_config: dict, 
                              analytiq_collections: dict,
@@ -104,32 +215,172 @@ def delete_chroma_collection(analytiq_config: dict,
                                       analytiq_collections=analytiq_collections)
     
     # Are there any files in the collection?
-    chroma_collection = st.session_state.chroma_collections[collection_name]
+    chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
+                                              analytiq_collections=analytiq_collections,
+                                              collection_name=collection_name)
     result = chroma_collection.get(limit=1, include=["metadatas"])
     if len(result['ids']) > 0:
         st.error(f"Cannot delete collection {collection_name} because it is not empty.")
         return False
     chroma_client.delete_collection(name=collection_name)
-    del st.session_state.chroma_collections[collection_name]
+
+    # Invalidate the shared handle, for all sessions
+    with _chroma_lock:
+        _chroma_collections.pop((analytiq_config["chroma_host"], analytiq_config["chroma_port"], collection_name), None)
+    update_chroma_membership(analytiq_config=analytiq_config,
+                             collection_name=collection_name,
+                             drop=True)
+    clear_bm25_collection(analytiq_config=analytiq_config, collection_name=collection_name)
+    invalidate_cached_answers(analytiq_config=analytiq_config, collection_name=collection_name)
 
     st.success(f"Deleted chroma collection {collection_name}")
     return True
 
+def _get_membership_fname(analytiq_config: dict) -> str:
+    return f"{analytiq_config['docstore']}/analytiq_membership.json"
+
+def _load_chroma_membership(fname: str) -> dict:
+    """
+    Load the membership index, or return None if it does not exist yet.
+    """
+    if not os.path.exists(fname):
+        return None
+
+    analytiq_membership = json.load(open(fname, "r"))
+    return {collection_name: set(uuids) 
+            for collection_name, uuids in analytiq_membership["collections"].items()}
+
+def get_chroma_membership(analytiq_config: dict) -> dict:
+    """
+    Get the membership index, mapping each collection name to the set of file uuids it holds.
+
+    The index is kept in analytiq_membership.json next to the docs manifest. If it
+    does not exist yet, it is rebuilt from Chroma.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+
+    Returns:
+        dict: Map from collection name to the set of file uuids.
+    """
+    membership = _load_chroma_membership(_get_membership_fname(analytiq_config))
+    if membership is None:
+        membership = reconcile_chroma_membership(analytiq_config=analytiq_config)
+    return membership
+
+def save_chroma_membership(analytiq_config: dict, membership: dict) -> None:
+    """
+    Save the membership index. The file is written to a temporary file and renamed
+    in place, so readers never see a partially written index.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        membership (dict): Map from collection name to the set of file uuids.
+    """
+    analytiq_membership = {
+        "schema_version": "1.0",
+        "collections": {collection_name: sorted(uuids) 
+                        for collection_name, uuids in membership.items()}
+    }
+    write_manifest(_get_membership_fname(analytiq_config), analytiq_membership)
+
+def update_chroma_membership(analytiq_config: dict,
+                             collection_name: str,
+                             add: list = [],
+                             remove: list = [],
+                             drop: bool = False) -> None:
+    """
+    Update the membership index of a collection, under the manifest lock, so that
+    concurrent sessions and processes do not lose each other's updates.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        add (list, optional): File uuids added to the collection. Defaults to [].
+        remove (list, optional): File uuids removed from the collection. Defaults to [].
+        drop (bool, optional): If True, the collection is emptied or deleted. Defaults to False.
+    """
+    fname = _get_membership_fname(analytiq_config)
+    with lock_manifest(fname):
+        membership = _load_chroma_membership(fname)
+        if membership is None:
+            membership = _scan_chroma_membership(get_chroma_client(analytiq_config=analytiq_config))
+        if drop:
+            membership.pop(collection_name, None)
+        else:
+            uuids = membership.setdefault(collection_name, set())
+            uuids.update(add)
+            uuids.difference_update(remove)
+        save_chroma_membership(analytiq_config=analytiq_config, membership=membership)
+
+def reconcile_chroma_membership(analytiq_config: dict) -> dict:
+    """
+    Rebuild the membership index from a paged metadata scan of all Chroma collections.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+
+    Returns:
+        dict: Map from collection name to the set of file uuids.
+    """
+    chroma_client = get_chroma_client(analytiq_config=analytiq_config)
+
+    with lock_manifest(_get_membership_fname(analytiq_config)):
+        membership = _scan_chroma_membership(chroma_client)
+        save_chroma_membership(analytiq_config=analytiq_config, membership=membership)
+
+    return membership
+
+def _scan_chroma_membership(chroma_client) -> dict:
+    """
+    Scan the metadata of all Chroma collections for the file uuids they hold.
+    """
+    membership = {}
+    for chroma_collection in chroma_client.list_collections():
+        uuids = set()
+        offset = 0
+        while True:
+            result = chroma_collection.get(limit=1000, offset=offset, include=["metadatas"])
+            result_size = len(result["metadatas"])
+            if result_size == 0:
+                break
+            offset += result_size
+            for metadata in result["metadatas"]:
+                uuids.add(metadata["uuid"])
+        membership[chroma_collection.name] = uuids
+
+    return membership
+
 def check_chroma_file(analytiq_config: dict, collection_name: str, file_manifest: dict) -> bool:
     """
     Return True if file is in the collection
     """
-    # Get the collection
-    chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
-                                              collection_name=collection_name)
+    membership = get_chroma_membership(analytiq_config=analytiq_config)
+    return file_manifest["uuid"] in membership.get(collection_name, set())
 
-    # Check if the file is in the collection
-    # Query the metadata only
-    result = chroma_collection.get(limit=1, where={"uuid": file_manifest["uuid"]}, include=["metadatas"])
-    if len(result['ids']) > 0:
-        return True
-    else:
-        return False
+def check_chroma_files(analytiq_config: dict,
+                       analytiq_collections: dict,
+                       file_manifests: list) -> dict:
+    """
+    Return the collections each file is in, from the membership index.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        analytiq_collections (dict): The collections configuration.
+        file_manifests (list): The file manifests to look up.
+
+    Returns:
+        dict: Map from file uuid to the list of collection names holding the file.
+    """
+    membership = get_chroma_membership(analytiq_config=analytiq_config)
+
+    file_collections = {}
+    for file_manifest in file_manifests:
+        id = file_manifest["uuid"]
+        file_collections[id] = [collection_name for collection_name in analytiq_collections
+                                if id in membership.get(collection_name, set())]
+
+    return file_collections
 
 def list_chroma_collection(analytiq_config: dict, collection_name: str):
     """
@@ -170,29 +421,242 @@ def clear_chroma_collection(analytiq_config: dict, collection_name: str):
         chroma_collection.delete(result['ids'])
         st.info(f"Deleted {len(result['ids'])} chunks from {collection_name}")
 
-def add_chroma_file_chunks(analytiq_config: dict, collection_name: str, 
-                           metadatas: dict, file_chunks: list):
+    update_chroma_membership(analytiq_config=analytiq_config,
+                             collection_name=collection_name,
+                             drop=True)
+    clear_bm25_collection(analytiq_config=analytiq_config, collection_name=collection_name)
+    invalidate_cached_answers(analytiq_config=analytiq_config, collection_name=collection_name)
+
+def get_chroma_fingerprints(analytiq_config: dict, collection_name: str) -> dict:
+    """
+    Get the collection fingerprints the stored chunks of each file were made with,
+    with a paged metadata scan of the collection.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+
+    Returns:
+        dict: For each file uuid, the list of distinct fingerprints of its chunks.
+            Chunks stored before fingerprinting have an empty fingerprint.
+    """
+    chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
+                                              collection_name=collection_name)
+
+    fingerprints = {}
+    offset = 0
+    while True:
+        result = chroma_collection.get(limit=1000, offset=offset, include=["metadatas"])
+        result_size = len(result["metadatas"])
+        if result_size == 0:
+            break
+        offset += result_size
+        for metadata in result["metadatas"]:
+            fingerprint = {key: metadata[key] for key in ["parse_fp", "split_fp", "embed_fp"] if key in metadata}
+            file_fingerprints = fingerprints.setdefault(metadata["uuid"], [])
+            if fingerprint not in file_fingerprints:
+                file_fingerprints.append(fingerprint)
+
+    return fingerprints
+
+def reset_chroma_collection(analytiq_config: dict, analytiq_collections: dict, collection_name: str):
+    """
+    Delete and recreate the Chroma collection, with the embedding of its configuration.
+
+    The vector index of a Chroma collection keeps the dimension of the first embeddings
+    added, so a new embedding model needs a new collection.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        analytiq_collections (dict): The collections configuration.
+        collection_name (str): The name of the collection.
+
+    Returns:
+        ChromaDB collection.
+    """
+    chroma_client = get_chroma_client(analytiq_config=analytiq_config)
+    try:
+        chroma_client.delete_collection(name=collection_name)
+    except ValueError:
+        # The collection does not exist
+        pass
+
+    # Invalidate the shared handle, for all sessions, and the indexes of the old chunks
+    with _chroma_lock:
+        _chroma_collections.pop((analytiq_config["chroma_host"], analytiq_config["chroma_port"], collection_name), None)
+    update_chroma_membership(analytiq_config=analytiq_config,
+                             collection_name=collection_name,
+                             drop=True)
+    clear_bm25_collection(analytiq_config=analytiq_config, collection_name=collection_name)
+    invalidate_cached_answers(analytiq_config=analytiq_config, collection_name=collection_name)
+
+    return get_chroma_collection(analytiq_config=analytiq_config,
+                                 analytiq_collections=analytiq_collections,
+                                 collection_name=collection_name)
+
+def check_chroma_embeddings(analytiq_config: dict, collection_name: str, embedding: str, embed_fp: str) -> bool:
+    """
+    Check that no chunk of the collection was embedded with another embedding configuration.
+
+    Chunks stored before fingerprinting do not record their embedding, so the dimension of the
+    stored vectors is compared to the dimension of the embedding model as well.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        embedding (str): The embedding model of the collection.
+        embed_fp (str): The current embedding fingerprint of the collection.
+
+    Returns:
+        bool: False if some chunks have another embedding fingerprint or dimension.
+    """
+    chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
+                                              collection_name=collection_name)
+    result = chroma_collection.get(where={"embed_fp": {"$ne": embed_fp}}, limit=1, include=[])
+    if len(result["ids"]) > 0:
+        return False
+
+    # All the vectors of a collection have the same dimension, so one chunk tells
+    result = chroma_collection.get(limit=1, include=["embeddings"])
+    if len(result["ids"]) == 0:
+        return True
+    return len(result["embeddings"][0]) == get_embedding_dimension(embedding)
+
+def get_chunk_ids(file_uuid: str, splitter_key: str, file_chunks: list) -> list:
+    """
+    Get the content-defined ids of the chunks of a file.
+
+    The id of a chunk is a hash of the file uuid, the splitter settings and the chunk text,
+    so splitting an unchanged file again gives the same ids. Repeated chunks of a file are numbered.
+
+    Args:
+        file_uuid (str): The file uuid.
+        splitter_key (str): The key of the collection splitter settings.
+        file_chunks (list): The file chunks.
+
+    Returns:
+        list: The chunk ids.
+    """
+    ids = []
+    n_seen = {}
+    for chunk in file_chunks:
+        chunk_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+        n = n_seen.get(chunk_hash, 0)
+        n_seen[chunk_hash] = n + 1
+        ids.append(hashlib.sha256(f"{file_uuid}\0{splitter_key}\0{chunk_hash}\0{n}".encode("utf-8")).hexdigest())
+    return ids
+
+def get_chroma_file_metadatas(analytiq_config: dict, collection_name: str, file_uuid: str) -> dict:
     """
-    Upload a file to the Chroma collection.
+    Get the metadatas of the chunks of a file stored in a Chroma collection.
 
     Args:
         analytiq_config (dict): The Analytiq configuration.
         collection_name (str): The name of the collection.
-        metadatas (dict): The list of file manifests.
+        file_uuid (str): The file uuid.
+
+    Returns:
+        dict: The chunk metadatas, keyed by chunk id.
+    """
+    chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
+                                              collection_name=collection_name)
+    result = chroma_collection.get(where={"uuid": file_uuid}, include=["metadatas"])
+    return dict(zip(result["ids"], result["metadatas"]))
+
+def upsert_chroma_file_chunks(analytiq_config: dict, collection_name: str,
+                              file_manifest: dict, chunk_ids: list, file_chunks: list,
+                              embedding: str = "all-MiniLM-L6-v2",
+                              embeddings: dict = None,
+                              fingerprint: dict = None) -> int:
+    """
+    Upload a file to the Chroma collection, writing only the chunks that changed.
+
+    Chunks already stored under the same id are kept, and only their metadata is updated if
+    the file manifest or the collection fingerprint changed. Stored chunks of the file that are
+    not in chunk_ids are deleted, after the new chunks are stored.
+    Uploading the same chunks again is a no-op, so an interrupted upload can simply be redone.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        file_manifest (dict): The file manifest, stored as the metadata of every chunk.
+        chunk_ids (list): The chunk ids, from get_chunk_ids.
         file_chunks (list): The file chunks.
+        embedding (str, optional): The embedding model of the collection. Defaults to "all-MiniLM-L6-v2".
+        embeddings (dict, optional): Precomputed embeddings of new chunks, keyed by chunk id.
+            The new chunks missing from it are embedded here. Defaults to None.
+        fingerprint (dict, optional): The collection fingerprint, from get_collection_fingerprint,
+            stored along with the file manifest. Defaults to None.
+
+    Returns:
+        int: The number of new chunks written.
     """
     # Get the collection
     chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
                                               collection_name=collection_name)
-    
-    # How many chunks?
-    n_chunks = len(file_chunks)
 
-    # Create the ids and metadatas
-    ids = [str(uuid.uuid1()) for _ in range(n_chunks)]
+    metadata = dict(file_manifest, **(fingerprint or {}))
+
+    # Diff the chunks against the stored chunks of the file
+    stored = get_chroma_file_metadatas(analytiq_config=analytiq_config,
+                                       collection_name=collection_name,
+                                       file_uuid=file_manifest["uuid"])
+    new_idx = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in stored]
+    changed_idx = [i for i, chunk_id in enumerate(chunk_ids)
+                   if chunk_id in stored and stored[chunk_id] != metadata]
+    stale_ids = list(set(stored) - set(chunk_ids))
+
+    if len(new_idx) > 0:
+        # Embed the new chunks with the shared model, unless the caller already did
+        embeddings = dict(embeddings or {})
+        missing_idx = [i for i in new_idx if chunk_ids[i] not in embeddings]
+        if len(missing_idx) > 0:
+            vectors = embed_chunks(analytiq_config=analytiq_config,
+                                   texts=[file_chunks[i] for i in missing_idx],
+                                   model_name=embedding)
+            embeddings.update(zip([chunk_ids[i] for i in missing_idx], vectors))
+
+        chroma_collection.upsert(ids=[chunk_ids[i] for i in new_idx],
+                                 metadatas=[metadata for _ in new_idx],
+                                 documents=[file_chunks[i] for i in new_idx],
+                                 embeddings=[embeddings[chunk_ids[i]].tolist() for i in new_idx])
+
+    if len(changed_idx) > 0:
+        # The chunk texts are unchanged, so only the metadata is rewritten
+        chroma_collection.update(ids=[chunk_ids[i] for i in changed_idx],
+                                 metadatas=[metadata for _ in changed_idx])
+
+    written_idx = new_idx + changed_idx
+    if len(written_idx) > 0:
+        add_bm25_chunks(analytiq_config=analytiq_config,
+                        collection_name=collection_name,
+                        ids=[chunk_ids[i] for i in written_idx],
+                        metadatas=[metadata for _ in written_idx],
+                        documents=[file_chunks[i] for i in written_idx])
+
+    # Delete the stale chunks only once the new ones are stored, so that a failed upload
+    # leaves the previous version of the file searchable
+    if len(stale_ids) > 0:
+        chroma_collection.delete(ids=stale_ids)
+        delete_bm25_chunks(analytiq_config=analytiq_config,
+                           collection_name=collection_name,
+                           ids=stale_ids)
+
+    # Update the membership index, and drop the answers citing the file
+    if len(chunk_ids) > 0:
+        update_chroma_membership(analytiq_config=analytiq_config,
+                                 collection_name=collection_name,
+                                 add=[file_manifest["uuid"]])
+    else:
+        update_chroma_membership(analytiq_config=analytiq_config,
+                                 collection_name=collection_name,
+                                 remove=[file_manifest["uuid"]])
+    if len(written_idx) > 0 or len(stale_ids) > 0:
+        invalidate_cached_answers(analytiq_config=analytiq_config,
+                                  collection_name=collection_name,
+                                  file_uuids=[file_manifest["uuid"]])
 
-    # Upload the file to the collection
-    chroma_collection.add(ids=ids, metadatas=metadatas, documents=file_chunks)
+    return len(new_idx)
 
 def delete_chroma_file_chunks(analytiq_config: dict, collection_name: str, file_manifest: dict):
     """
@@ -205,28 +669,152 @@ def delete_chroma_file_chunks(analytiq_config: dict, collection_name: str, file_
     # Delete the file from the collection
     chroma_collection.delete(where={"uuid": file_manifest["uuid"]})
 
-@st.cache_resource(ttl="1h")
-def get_chroma_retriever(analytiq_config: dict = {},
-                         collection_name: str = "default",
-                         search_k: int = 2,
-                         fetch_k: int = 4) -> Chroma:
+    # Update the membership and keyword indexes, and drop the answers citing the file
+    update_chroma_membership(analytiq_config=analytiq_config,
+                             collection_name=collection_name,
+                             remove=[file_manifest["uuid"]])
+    delete_bm25_file(analytiq_config=analytiq_config,
+                     collection_name=collection_name,
+                     file_uuid=file_manifest["uuid"])
+    invalidate_cached_answers(analytiq_config=analytiq_config,
+                              collection_name=collection_name,
+                              file_uuids=[file_manifest["uuid"]])
+
+def update_chroma_file_manifest(analytiq_config: dict, file_manifest: dict, file_manifest_orig: dict):
     """
-    Get a Chroma collection retriever from the ChromaDB server.
+    Update the file manifest stored in the chunk metadata of a file, in every collection holding
+    the file, after its name, type or year was edited. The keyword indexes are updated too, and
+    the cached answers that the new type or year affects are dropped.
 
     Args:
-        collection_name (str, optional): The name of the collection. Defaults to "public_records".
-        search_k (int, optional): The number of documents to search. Defaults to 2.
-        fetch_k (int, optional): The number of documents to fetch. Defaults to 4.
+        analytiq_config (dict): The Analytiq configuration.
+        file_manifest (dict): The file manifest, as saved.
+        file_manifest_orig (dict): The file manifest, before the edit.
+    """
+    fields = ["file_name", "type", "year"]
+    if all(file_manifest[field] == file_manifest_orig[field] for field in fields):
+        return
+
+    membership = get_chroma_membership(analytiq_config=analytiq_config)
+    for collection_name, uuids in membership.items():
+        if file_manifest["uuid"] not in uuids:
+            continue
+
+        chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
+                                                  collection_name=collection_name)
+        stored = get_chroma_file_metadatas(analytiq_config=analytiq_config,
+                                           collection_name=collection_name,
+                                           file_uuid=file_manifest["uuid"])
+        if len(stored) > 0:
+            chroma_collection.update(ids=list(stored),
+                                     metadatas=[dict(metadata, **{field: file_manifest[field] for field in fields})
+                                                for metadata in stored.values()])
+        update_bm25_file(analytiq_config=analytiq_config,
+                         collection_name=collection_name,
+                         file_manifest=file_manifest)
+        invalidate_recategorized_answers(analytiq_config=analytiq_config,
+                                         collection_name=collection_name,
+                                         file_manifest=file_manifest,
+                                         file_manifest_orig=file_manifest_orig)
+
+def get_chroma_chunks(analytiq_config: dict, collection_name: str, chunk_ids: list) -> list:
+    """
+    Get chunks of a Chroma collection by id.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        chunk_ids (list): The Chroma ids of the chunks.
 
     Returns:
-        Chroma: A Chroma collection.
+        list: The chunks still in the collection, as langchain Documents in chunk_ids order,
+            with the Chroma id in the "chunk_id" metadata.
     """
-    client = get_chroma_client(analytiq_config=analytiq_config)
-    embedding_function = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-    chroma_collection = Chroma(client=client, 
-                               collection_name=collection_name, 
-                               embedding_function=embedding_function)
+    if len(chunk_ids) == 0:
+        return []
 
-    return chroma_collection.as_retriever(search_type="mmr", 
-                                          search_kwargs={"k": search_k, 
-                                                         "fetch_k": fetch_k})
+    chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
+                                              collection_name=collection_name)
+    result = chroma_collection.get(ids=list(chunk_ids), include=["metadatas", "documents"])
+    chunks = {chunk_id: Document(page_content=document, metadata=dict(metadata, chunk_id=chunk_id))
+              for chunk_id, metadata, document in zip(result["ids"], result["metadatas"], result["documents"])}
+
+    return [chunks[chunk_id] for chunk_id in chunk_ids if chunk_id in chunks]
+
+def get_chroma_where(doc_types: list = [], doc_years: list = []) -> dict:
+    """
+    Get the Chroma where clause selecting the chunks of documents of some types and years.
+
+    Args:
+        doc_types (list, optional): The document types. Defaults to all types.
+        doc_years (list, optional): The document years. Defaults to all years.
+
+    Returns:
+        dict: The where clause, or None to select all chunks.
+    """
+    conditions = []
+    for field, values in [("type", doc_types), ("year", doc_years)]:
+        if len(values) == 1:
+            conditions.append({field: values[0]})
+        elif len(values) > 1:
+            conditions.append({field: {"$in": list(values)}})
+
+    if len(conditions) == 0:
+        return None
+    elif len(conditions) == 1:
+        return conditions[0]
+    else:
+        return {"$and": conditions}
+
+def search_chroma_chunks(analytiq_config: dict,
+                         collection_name: str,
+                         query: str,
+                         k: int = 2,
+                         fetch_k: int = 4,
+                         doc_types: list = [],
+                         doc_years: list = [],
+                         embedding: str = "all-MiniLM-L6-v2") -> list:
+    """
+    Search a Chroma collection for the chunks closest to a query, diversified with maximal marginal relevance.
+
+    The query is embedded with the shared embedding model and the query embedding cache,
+    so changing k or fetch_k, or repeating a query, does not reload or re-embed anything.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        query (str): The query text.
+        k (int, optional): The number of chunks to return. Defaults to 2.
+        fetch_k (int, optional): The number of nearest chunks to select from. Defaults to 4.
+        doc_types (list, optional): Only search documents of these types. Defaults to all types.
+        doc_years (list, optional): Only search documents of these years. Defaults to all years.
+        embedding (str, optional): The embedding model of the collection. Defaults to "all-MiniLM-L6-v2".
+
+    Returns:
+        list: The chunks, as langchain Documents with the Chroma id in the "chunk_id" metadata.
+    """
+    chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
+                                              collection_name=collection_name)
+    query_embedding = embed_query(query,
+                                  model_name=embedding,
+                                  cache_size=analytiq_config.get("query_cache_size", 1024))
+
+    # Only search the chunks of the selected document types and years
+    result = chroma_collection.query(query_embeddings=[query_embedding.tolist()],
+                                     n_results=max(k, fetch_k),
+                                     where=get_chroma_where(doc_types=doc_types, doc_years=doc_years),
+                                     include=["metadatas", "documents", "embeddings"])
+    ids = result["ids"][0]
+    if len(ids) == 0:
+        return []
+
+    selected = maximal_marginal_relevance(query_embedding,
+                                          result["embeddings"][0],
+                                          k=min(k, len(ids)))
+
+    docs = []
+    for idx in selected:
+        metadata = dict(result["metadatas"][0][idx])
+        metadata["chunk_id"] = ids[idx]
+        docs.append(Document(page_content=result["documents"][0][idx], metadata=metadata))
+    return docs
@@ -1,5 +1,12 @@
+import os
+import json
+import glob
+import hashlib
+import threading
 import tiktoken
+from importlib.metadata import version, PackageNotFoundError
 
+from langchain.schema import Document
 from langchain.document_loaders import UnstructuredPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter, CharacterTextSplitter, Language
 from langchain.document_loaders.pdf import PyPDFLoader
@@ -28,10 +35,143 @@ def get_collection_loader(analytiq_config: dict,
 
     return loader
 
+# The packages implementing each parser, whose version is part of the parse cache key
+parser_packages = {
+    "unstructured": "unstructured",
+    "pypdf": "pypdf",
+}
+
+def get_parser_version(parser: str) -> str:
+    """
+    Get the version of the package implementing a parser
+
+    Args:
+        parser (str): The parser name.
+
+    Returns:
+        str: The package version.
+    """
+    try:
+        return version(parser_packages[parser])
+    except (KeyError, PackageNotFoundError):
+        return "unknown"
+
+def get_file_hash(file_path: str) -> str:
+    """
+    Get the sha256 hash of a file, reading it in chunks
+
+    Args:
+        file_path (str): The file path.
+
+    Returns:
+        str: The hex digest.
+    """
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_collection_docs(analytiq_config: dict,
+                         collection: dict,
+                         file_manifest: dict) -> list:
+    """
+    Parse a file with the collection parser, reusing the cached parser output if
+    the file and the parser have not changed.
+
+    The parser output is cached under doc/<uuid>/parsed/, keyed by the parser,
+    the parser version and the file hash.
+
+    Args:
+        analytiq_config (dict): The configuration.
+        collection (dict): The collection configuration.
+        file_manifest (dict): The file manifest.
+
+    Returns:
+        list: The parsed documents.
+    """
+    file_dir = f"{analytiq_config['docstore']}/doc/{file_manifest['uuid']}"
+    file_path = f"{file_dir}/{file_manifest['file_name']}"
+
+    parser = collection["parser"]
+    parser_version = get_parser_version(parser)
+    file_hash = file_manifest.get("sha256") or get_file_hash(file_path)
+
+    cache_dir = f"{file_dir}/parsed"
+    cache_prefix = f"{cache_dir}/{parser}-"
+    cache_fname = f"{cache_prefix}{parser_version}-{file_hash}.json"
+    if os.path.exists(cache_fname):
+        parsed = json.load(open(cache_fname, "r"))
+        return [Document(page_content=doc["page_content"], metadata=doc["metadata"]) 
+                for doc in parsed["docs"]]
+
+    loader = get_collection_loader(analytiq_config=analytiq_config,
+                                   collection=collection,
+                                   file_path=file_path)
+    docs = loader.load()
+
+    # Save the parser output, replacing the output of older parser versions and file contents
+    parsed = {
+        "schema_version": "1.0",
+        "parser": parser,
+        "parser_version": parser_version,
+        "sha256": file_hash,
+        "docs": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    for fname in glob.glob(f"{glob.escape(cache_prefix)}*.json"):
+        os.remove(fname)
+    cache_fname_tmp = f"{cache_fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(cache_fname_tmp, "w") as f:
+        json.dump(parsed, f)
+    os.replace(cache_fname_tmp, cache_fname)
+
+    return docs
+
 _enc = tiktoken.get_encoding("cl100k_base")
 def cl100k_base_length_function(text: str) -> int:
     return len(_enc.encode(text))
 
+def cl100k_base_truncate(text: str, max_tokens: int) -> str:
+    return _enc.decode(_enc.encode(text)[:max_tokens])
+
+
+# The collection settings that decide how a parsed file is split into chunks
+splitter_settings = ["splitter", "chunk_size", "chunk_overlap", "length_function"]
+
+def get_splitter_key(collection: dict) -> str:
+    """
+    Get a key of the collection splitter settings, which the chunk ids are derived from
+
+    Args:
+        collection (dict): The collection configuration.
+
+    Returns:
+        str: The splitter key.
+    """
+    return json.dumps({setting: collection[setting] for setting in splitter_settings}, sort_keys=True)
+
+def get_collection_fingerprint(collection: dict) -> dict:
+    """
+    Get the fingerprints of the collection settings each ingestion stage depends on.
+    The fingerprints are stored in the metadata of every chunk, to find the chunks made
+    with older settings.
+
+    Args:
+        collection (dict): The collection configuration.
+
+    Returns:
+        dict: The "parse_fp", "split_fp" and "embed_fp" fingerprints.
+    """
+    def fingerprint(settings) -> str:
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    parser = collection["parser"]
+    return {
+        "parse_fp": fingerprint({"parser": parser, "parser_version": get_parser_version(parser)}),
+        "split_fp": fingerprint(get_splitter_key(collection)),
+        "embed_fp": fingerprint(collection["embedding"]),
+    }
 
 def get_collection_splitter(analytiq_config: dict,
                             collection: dict):
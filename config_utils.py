@@ -1,14 +1,59 @@
 import os
 import json
-import copy
+import time
+import hashlib
+import fcntl
+import sqlite3
+import threading
+import contextlib
 from datetime import datetime
 import uuid
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
-# Globals
-categories_orig = {}
-collections_orig = {}
-docs_orig = {}
+# Docstores initialized by this process
+_initialized_docstores = set()
+
+# Process-wide cache of parsed manifests, shared by all sessions. Cached values are
+# never handed out directly, so they are never modified.
+_manifest_cache = {}
+_manifest_cache_lock = threading.Lock()
+
+class ManifestConflictError(Exception):
+    """
+    Raised when a manifest was changed by another session since it was read
+    """
+
+@contextlib.contextmanager
+def lock_manifest(fname: str):
+    """
+    Hold an exclusive advisory lock on a manifest, across threads and processes.
+
+    Args:
+        fname (str): The manifest file name. The lock is taken on fname.lock.
+    """
+    with open(f"{fname}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def write_manifest(fname: str, manifest: dict) -> None:
+    """
+    Write a manifest to a temporary file and rename it in place, so readers
+    never see a partially written manifest.
+
+    Args:
+        fname (str): The manifest file name.
+        manifest (dict): The manifest.
+    """
+    fname_tmp = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(fname_tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(fname_tmp, fname)
 
 def init_analytiq_config(analytiq_config: dict = {}) -> None:
     """
@@ -17,16 +62,35 @@ def init_analytiq_config(analytiq_config: dict = {}) -> None:
     Args:
         analytiq_config (dict, optional): The ChromaDB configuration. Defaults to {}.
     """
-    # Ensure the chroma folder structure is set up
+    # Ensure the chroma folder structure is set up, once per process
     analytiq_docstore = analytiq_config["docstore"]
+    if analytiq_docstore in _initialized_docstores:
+        return
+
     os.makedirs(analytiq_docstore, exist_ok=True)
     os.makedirs(f"{analytiq_docstore}/doc", exist_ok=True)
     
-    fname = f"{analytiq_docstore}/analytiq_docs.json"
-    if not os.path.exists(fname):
-        # By default, there are no documents
-        json.dump({"schema_version": "1.0", "docs": []}, open(fname, "w"), indent=2)
-        st.info(f"Created {fname}")
+    fname = f"{analytiq_docstore}/analytiq_docs.db"
+    created = not os.path.exists(fname)
+    # By default, there are no documents. Import them from the older JSON docstore, if any.
+    # The import is recorded in the database, so that an import that failed is retried.
+    conn = _get_docs_db(analytiq_config)
+    fname_json = f"{analytiq_docstore}/analytiq_docs.json"
+    migrated = conn.execute("SELECT 1 FROM migrations WHERE name = 'docs_json'").fetchone() is not None
+    if not migrated and conn.execute("SELECT 1 FROM docs LIMIT 1").fetchone() is not None:
+        # Databases migrated before the migrations were recorded have documents
+        migrated = True
+    try:
+        if os.path.exists(fname_json) and not migrated:
+            n_docs = migrate_docs_json(analytiq_config, conn, fname_json)
+            st.info(f"Migrated {n_docs} documents from {fname_json} to {fname}")
+        elif created:
+            st.info(f"Created {fname}")
+    except Exception as e:
+        st.error(f"Failed to migrate the documents from {fname_json}, will retry on restart: {e}")
+        raise
+    finally:
+        conn.close()
     
     fname = f"{analytiq_docstore}/analytiq_categories.json"
     if not os.path.exists(fname):
@@ -50,9 +114,10 @@ def init_analytiq_config(analytiq_config: dict = {}) -> None:
         current_year = datetime.now().year
         categories_def["year"] = [str(year) for year in range(current_year, current_year-10, -1)]
 
-        json.dump({"schema_version": "1.0", "categories": categories_def}, 
-                  open(fname, "w"), indent=2)
-        st.info(f"Created {fname}")
+        with lock_manifest(fname):
+            if not os.path.exists(fname):
+                write_manifest(fname, {"schema_version": "1.0", "version": 0, "categories": categories_def})
+                st.info(f"Created {fname}")
     
     fname = f"{analytiq_docstore}/analytiq_collections.json"
     if not os.path.exists(fname):
@@ -68,39 +133,208 @@ def init_analytiq_config(analytiq_config: dict = {}) -> None:
                 }
             }
 
-        json.dump({"schema_version": "1.0", "collections": collections_def}, 
-                  open(fname, "w"), indent=2)
-        st.info(f"Created {fname}")
+        with lock_manifest(fname):
+            if not os.path.exists(fname):
+                write_manifest(fname, {"schema_version": "1.0", "version": 0, "collections": collections_def})
+                st.info(f"Created {fname}")
 
-def get_analytiq_config() -> dict:
+    _initialized_docstores.add(analytiq_docstore)
+
+def load_analytiq_config() -> dict:
     """
-    Get the ChromaDB configuration
+    Load the Analytiq configuration from the environment, without Streamlit.
 
     Returns:
-        dict: A dictionary containing the ChromaDB configuration.
+        dict: A dictionary containing the Analytiq configuration.
+
+    Raises:
+        ValueError: If a required environment variable is not set.
     """
 
     config = {
         "chroma_host": os.getenv("CHROMA_HOST"),
         "chroma_port": os.getenv("CHROMA_PORT"),
-        "docstore": os.getenv("ANALYTIQ_DOCSTORE")
+        "docstore": os.getenv("ANALYTIQ_DOCSTORE"),
+        # Ingestion pipeline tuning
+        "parse_workers": int(os.getenv("ANALYTIQ_PARSE_WORKERS", os.cpu_count() or 1)),
+        "ingest_queue_size": int(os.getenv("ANALYTIQ_INGEST_QUEUE_SIZE", 8)),
+        "embed_batch_size": int(os.getenv("ANALYTIQ_EMBED_BATCH_SIZE", 64)),
+        "embed_cache_mb": int(os.getenv("ANALYTIQ_EMBED_CACHE_MB", 1024)),
+        "ingest_worker": os.getenv("ANALYTIQ_INGEST_WORKER", "thread"),
+        "ingest_workers": int(os.getenv("ANALYTIQ_INGEST_WORKERS", 2)),
+        # Retrieval tuning
+        "query_cache_size": int(os.getenv("ANALYTIQ_QUERY_CACHE_SIZE", 1024)),
+        "answer_cache_ttl": int(os.getenv("ANALYTIQ_ANSWER_CACHE_TTL", 86400)),
+        "answer_cache_threshold": float(os.getenv("ANALYTIQ_ANSWER_CACHE_THRESHOLD", 0.95)),
+        "rerank_model": os.getenv("ANALYTIQ_RERANK_MODEL", ""),
+        "rerank_top_n": int(os.getenv("ANALYTIQ_RERANK_TOP_N", 4)),
+        "rerank_budget_ms": int(os.getenv("ANALYTIQ_RERANK_BUDGET_MS", 500)),
+        "rerank_batch_size": int(os.getenv("ANALYTIQ_RERANK_BATCH_SIZE", 16)),
+        "chat_memory_tokens": int(os.getenv("ANALYTIQ_CHAT_MEMORY_TOKENS", 1000)),
+        "chat_rate_per_minute": float(os.getenv("ANALYTIQ_CHAT_RATE_PER_MINUTE", 10)),
+        "chat_rate_burst": int(os.getenv("ANALYTIQ_CHAT_RATE_BURST", 3)),
+        "chat_concurrency": int(os.getenv("ANALYTIQ_CHAT_CONCURRENCY", 16)),
+        # Docstore file server
+        "file_server_address": os.getenv("ANALYTIQ_FILE_SERVER_ADDRESS", ""),
+        "file_server_port": int(os.getenv("ANALYTIQ_FILE_SERVER_PORT", 8502)),
+        "file_server_url": os.getenv("ANALYTIQ_FILE_SERVER_URL", "")
     }
 
     if config["chroma_host"] is None:
-        st.error("CHROMA_HOST is not set in the .env file.")
-        st.stop()
+        raise ValueError("CHROMA_HOST is not set in the .env file.")
     if config["chroma_port"] is None:
-        st.error("CHROMA_PORT is not set in the .env file.")
-        st.stop()
+        raise ValueError("CHROMA_PORT is not set in the .env file.")
     if config["docstore"] is None:
-        st.error("ANALYTIQ_DOCSTORE is not set in the .env file.")
-        st.stop()
+        raise ValueError("ANALYTIQ_DOCSTORE is not set in the .env file.")
     
     # Initialize the config
     init_analytiq_config(config)
 
     return config
 
+def get_analytiq_config() -> dict:
+    """
+    Get the ChromaDB configuration
+
+    Returns:
+        dict: A dictionary containing the ChromaDB configuration.
+    """
+    try:
+        return load_analytiq_config()
+    except ValueError as e:
+        st.error(str(e))
+        st.stop()
+
+class _LocalSessionState(dict):
+    """
+    Stand-in for st.session_state outside of a Streamlit script run
+    """
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def __delattr__(self, key):
+        del self[key]
+
+local_session_state = _LocalSessionState()
+
+def get_session_state():
+    """
+    Get the session state. Inside a Streamlit script run, this is st.session_state.
+    From the command line or a background thread, this is a process-wide state.
+
+    Returns:
+        The session state.
+    """
+    if get_script_run_ctx() is None:
+        return local_session_state
+    return st.session_state
+
+def _copy_manifest(value: dict) -> dict:
+    """
+    Copy a manifest deep enough that the pages can edit it: manifests map names
+    to lists of values, or to dicts of settings.
+    """
+    return {key: item.copy() if isinstance(item, (list, dict)) else item
+            for key, item in value.items()}
+
+def _stat_key(fname: str) -> tuple:
+    """
+    Get the file attributes that change whenever a manifest is replaced.
+    """
+    stat = os.stat(fname)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def _read_manifest(fname: str, name: str) -> tuple:
+    """
+    Read a manifest through the process-wide cache, parsing it only if the file changed.
+
+    Returns:
+        tuple: The cached manifest contents and version. Do not modify them.
+    """
+    stat_key = _stat_key(fname)
+    with _manifest_cache_lock:
+        cached = _manifest_cache.get(fname)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1], cached[2]
+
+    analytiq_manifest = json.load(open(fname, "r"))
+    value = analytiq_manifest[name]
+    version = analytiq_manifest.get("version", 0)
+    with _manifest_cache_lock:
+        _manifest_cache[fname] = (stat_key, value, version)
+    return value, version
+
+def get_manifest(analytiq_config: dict, name: str) -> dict:
+    """
+    Get a JSON manifest, remembering what this session read, for save_manifest.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        name (str): The manifest name, "categories" or "collections".
+
+    Returns:
+        dict: The manifest contents.
+    """
+    fname = f"{analytiq_config['docstore']}/analytiq_{name}.json"
+    value, version = _read_manifest(fname, name)
+
+    # Save the original manifest and its version, per session. The cached value serves
+    # as the original, since it is never modified.
+    session_state = get_session_state()
+    session_state[f"{name}_orig"] = value
+    session_state[f"{name}_version"] = version
+
+    return _copy_manifest(value)
+
+def save_manifest(analytiq_config: dict, name: str, value: dict) -> None:
+    """
+    Save a JSON manifest, if it has changed since get_manifest.
+
+    The write is rejected if another session saved the manifest since this session read it.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        name (str): The manifest name, "categories" or "collections".
+        value (dict): The manifest contents.
+
+    Raises:
+        ManifestConflictError: If the manifest was changed by another session.
+    """
+    session_state = get_session_state()
+    if value == session_state.get(f"{name}_orig"):
+        # Manifest has not changed
+        return
+
+    fname = f"{analytiq_config['docstore']}/analytiq_{name}.json"
+    with lock_manifest(fname):
+        _, version = _read_manifest(fname, name)
+        if version != session_state.get(f"{name}_version"):
+            raise ManifestConflictError(f"The {name} were changed by another session. Reload the page and try again.")
+
+        analytiq_manifest = {
+            "schema_version": "1.0",
+            "version": version + 1,
+            name: value
+        }
+        write_manifest(fname, analytiq_manifest)
+
+        # Cache a copy of what was written, since the caller may keep editing value
+        value_saved = _copy_manifest(value)
+        with _manifest_cache_lock:
+            _manifest_cache[fname] = (_stat_key(fname), value_saved, version + 1)
+
+    st.info(f"Saved {fname}")
+
+    # Save the original manifest and its version
+    session_state[f"{name}_orig"] = value_saved
+    session_state[f"{name}_version"] = version + 1
+
 def get_categories(analytiq_config: dict = {}) -> dict:
     """
     Get the categories configuration
@@ -111,40 +345,25 @@ def get_categories(analytiq_config: dict = {}) -> dict:
     Returns:
         dict: A dictionary containing the categories configuration.
     """
-    global categories_orig
-
-    analytiq_categories = json.load(open(f"{analytiq_config['docstore']}/analytiq_categories.json", "r"))
-    categories = analytiq_categories["categories"]
+    return get_manifest(analytiq_config, "categories")
 
-    # Save the original categories
-    categories_orig = copy.deepcopy(categories)
-
-    return categories
-
-def save_categories(analytiq_config: dict = {}, categories: dict = {}) -> None:
+def save_categories(analytiq_config: dict = {}, categories: dict = {}) -> bool:
     """
     Save the categories configuration
 
     Args:
         analytiq_config (dict, optional): The ChromaDB configuration. Defaults to {}.
         categories (dict, optional): The categories configuration. Defaults to {}.
-    """
-    global categories_orig
 
-    if categories == categories_orig:
-        # Categories have not changed
-        return
-
-    analytiq_categories = {
-        "schema_version": "1.0",
-        "categories": categories
-    }
-    fname = f"{analytiq_config['docstore']}/analytiq_categories.json"
-    json.dump(analytiq_categories, open(fname, "w"), indent=2)
-    st.info(f"Saved {fname}")
-
-    # Save the original categories
-    categories_orig = copy.deepcopy(categories)
+    Returns:
+        bool: False if the categories were changed by another session, and were not saved.
+    """
+    try:
+        save_manifest(analytiq_config, "categories", categories)
+    except ManifestConflictError as e:
+        st.error(str(e))
+        return False
+    return True
 
 def get_collections(analytiq_config: dict = {}) -> dict:
     """
@@ -156,86 +375,462 @@ def get_collections(analytiq_config: dict = {}) -> dict:
     Returns:
         dict: A dictionary containing the collections configuration.
     """
-    global collections_orig
-
-    analytiq_collections = json.load(open(f"{analytiq_config['docstore']}/analytiq_collections.json", "r"))
-    collections = analytiq_collections["collections"]
-
-    # Save the original collections
-    collections_orig = copy.deepcopy(collections)
+    return get_manifest(analytiq_config, "collections")
 
-    return collections
-
-def save_collections(analytiq_config: dict = {}, collections: dict = {}) -> None:
+def save_collections(analytiq_config: dict = {}, collections: dict = {}) -> bool:
     """
     Save the collections configuration
 
     Args:
         analytiq_config (dict, optional): The Analytiq configuration. Defaults to {}.
         collections (dict, optional): The collections configuration. Defaults to {}.
+
+    Returns:
+        bool: False if the collections were changed by another session, and were not saved.
     """
-    global collections_orig
+    try:
+        save_manifest(analytiq_config, "collections", collections)
+    except ManifestConflictError as e:
+        st.error(str(e))
+        return False
+    return True
 
-    if collections == collections_orig:
-        # Collections have not changed
-        return
+# The columns of the docs table, in manifest order
+doc_fields = ["file_name", "uuid", "type", "year"]
+# Fields a file manifest may lack, e.g. files added before content hashing
+doc_optional_fields = ["sha256"]
 
-    analytiq_collections = {
-        "schema_version": "1.0",
-        "collections": collections
-    }
-    fname = f"{analytiq_config['docstore']}/analytiq_collections.json"
-    json.dump(analytiq_collections, open(fname, "w"), indent=2)
-    st.info(f"Saved {fname}")
+# Docs databases whose schema was ensured by this process
+_docs_db_ready = set()
+
+# Process-wide cache of the docs, keyed by docs database, with the docs version it was read at
+_docs_cache = {}
+
+def _get_docs_db(analytiq_config: dict) -> sqlite3.Connection:
+    """
+    Open the documents database, kept in analytiq_docs.db in the docstore.
 
-    # Save the original collections
-    collections_orig = copy.deepcopy(collections)
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
 
-def get_docs(analytiq_config: dict = {}) -> dict:
+    Returns:
+        sqlite3.Connection: A connection to the documents database.
+    """
+    fname = f"{analytiq_config['docstore']}/analytiq_docs.db"
+    conn = sqlite3.connect(fname, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if fname in _docs_db_ready:
+        return conn
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS docs (
+            uuid TEXT PRIMARY KEY,
+            file_name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            year TEXT NOT NULL,
+            sha256 TEXT
+        );
+        CREATE INDEX IF NOT EXISTS docs_file_name ON docs (file_name);
+        CREATE INDEX IF NOT EXISTS docs_type ON docs (type);
+        CREATE INDEX IF NOT EXISTS docs_year ON docs (year);
+
+        -- Bumped on every change to the docs, to validate cached reads
+        CREATE TABLE IF NOT EXISTS docs_version (version INTEGER NOT NULL);
+        INSERT INTO docs_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM docs_version);
+        CREATE TRIGGER IF NOT EXISTS docs_insert AFTER INSERT ON docs
+            BEGIN UPDATE docs_version SET version = version + 1; END;
+        CREATE TRIGGER IF NOT EXISTS docs_update AFTER UPDATE ON docs
+            BEGIN UPDATE docs_version SET version = version + 1; END;
+        CREATE TRIGGER IF NOT EXISTS docs_delete AFTER DELETE ON docs
+            BEGIN UPDATE docs_version SET version = version + 1; END;
+
+        -- The one-time data migrations that completed
+        CREATE TABLE IF NOT EXISTS migrations (
+            name TEXT PRIMARY KEY,
+            done_at REAL NOT NULL
+        );
+    """)
+
+    # Add the content hash to databases created before it
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(docs)")]
+    if "sha256" not in columns:
+        with conn:
+            conn.execute("ALTER TABLE docs ADD COLUMN sha256 TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS docs_sha256 ON docs (sha256)")
+
+    _docs_db_ready.add(fname)
+    return conn
+
+def _get_all_docs(analytiq_config: dict) -> list:
+    """
+    Get all the docs through the process-wide cache, reading the database only if
+    the docs changed since the cached read.
+
+    Returns:
+        list: The cached file manifests. Do not modify them.
+    """
+    conn = _get_docs_db(analytiq_config)
+    version = conn.execute("SELECT version FROM docs_version").fetchone()[0]
+    cached = _docs_cache.get(analytiq_config["docstore"])
+    if cached is not None and cached[0] == version:
+        conn.close()
+        return cached[1]
+
+    # Read the version and the docs in one transaction, so they match
+    with conn:
+        conn.execute("BEGIN")
+        version = conn.execute("SELECT version FROM docs_version").fetchone()[0]
+        rows = conn.execute(f"SELECT {', '.join(doc_fields + doc_optional_fields)} FROM docs ORDER BY rowid").fetchall()
+    conn.close()
+
+    docs = [_row_to_doc(row) for row in rows]
+    _docs_cache[analytiq_config["docstore"]] = (version, docs)
+    return docs
+
+def _row_to_doc(row: sqlite3.Row) -> dict:
+    """
+    Convert a docs row to a file manifest, leaving out the optional fields it lacks.
+    """
+    return {field: row[field] for field in row.keys() 
+            if field in doc_fields or row[field] is not None}
+
+def migrate_docs_json(analytiq_config: dict, conn: sqlite3.Connection, fname: str) -> int:
+    """
+    Import the documents of a JSON docstore (schema version 1.0) into the documents database.
+
+    The documents and the completion of the migration are committed together. The uuids given
+    to the files moved into their uuid folder are written back to the JSON docstore, even if
+    the migration fails, so that a retry finds the files.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        conn (sqlite3.Connection): A connection to the documents database.
+        fname (str): The analytiq_docs.json file name.
+
+    Returns:
+        int: The number of documents imported.
+    """
+    analytiq_docs = json.load(open(fname, "r"))
+    try:
+        docs = [normalize_doc(analytiq_config, doc) for doc in analytiq_docs["docs"]]
+    finally:
+        if any("uuid" in doc for doc in analytiq_docs["docs"]):
+            write_manifest(fname, analytiq_docs)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO docs (file_name, uuid, type, year) VALUES (?, ?, ?, ?)",
+                         [(doc["file_name"], doc["uuid"], doc["type"], doc["year"]) for doc in docs])
+        conn.execute("INSERT OR REPLACE INTO migrations (name, done_at) VALUES ('docs_json', ?)", (time.time(),))
+    return len(docs)
+
+def _select_docs(analytiq_config: dict, where: str = "", params: list = []) -> list:
+    """
+    Select documents, in the order they were added.
+    """
+    conn = _get_docs_db(analytiq_config)
+    rows = conn.execute(f"SELECT {', '.join(doc_fields + doc_optional_fields)} FROM docs {where} ORDER BY rowid", params).fetchall()
+    conn.close()
+    return [_row_to_doc(row) for row in rows]
+
+def get_docs(analytiq_config: dict = {},
+             doc_types: list = [],
+             doc_years: list = []) -> list:
     """
     Get the documents configuration
 
     Args:
         analytiq_config (dict, optional): The ChromaDB configuration. Defaults to {}.
+        doc_types (list, optional): Only get the documents of these types. Defaults to all types.
+        doc_years (list, optional): Only get the documents of these years. Defaults to all years.
     
     Returns:
-        dict: A dictionary containing the documents configuration.
+        list: A list containing the file manifests.
     """
-    global docs_orig
+    docs = _get_all_docs(analytiq_config)
 
-    analytiq_docs = json.load(open(f"{analytiq_config['docstore']}/analytiq_docs.json", "r"))
-    docs = analytiq_docs["docs"]
+    if len(doc_types) == 0 and len(doc_years) == 0:
+        # Save the original documents per session. The cached docs serve as the
+        # originals, since they are never modified.
+        get_session_state()["docs_orig"] = {doc["uuid"]: doc for doc in docs}
+    else:
+        docs = [doc for doc in docs 
+                if (len(doc_types) == 0 or doc["type"] in doc_types) and 
+                   (len(doc_years) == 0 or doc["year"] in doc_years)]
 
-    # Save the original documents
-    docs_orig = copy.deepcopy(docs)
+    return [dict(doc) for doc in docs]
 
-    return docs
+def get_doc(analytiq_config: dict, file_uuid: str) -> dict:
+    """
+    Get a file manifest by uuid
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        file_uuid (str): The file uuid.
+
+    Returns:
+        dict: The file manifest, or None if there is no such file.
+    """
+    docs = _select_docs(analytiq_config, "WHERE uuid = ?", [file_uuid])
+    return docs[0] if len(docs) > 0 else None
+
+def get_doc_by_name(analytiq_config: dict, file_name: str) -> dict:
+    """
+    Get a file manifest by file name
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        file_name (str): The file name.
+
+    Returns:
+        dict: The file manifest, or None if there is no such file.
+    """
+    docs = _select_docs(analytiq_config, "WHERE file_name = ?", [file_name])
+    return docs[0] if len(docs) > 0 else None
+
+def get_doc_by_hash(analytiq_config: dict, sha256: str) -> dict:
+    """
+    Get a file manifest by content hash
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        sha256 (str): The sha256 hex digest of the file contents.
+
+    Returns:
+        dict: The file manifest, or None if there is no file with these contents.
+    """
+    docs = _select_docs(analytiq_config, "WHERE sha256 = ?", [sha256])
+    return docs[0] if len(docs) > 0 else None
+
+def count_docs(analytiq_config: dict, category: str, value: str) -> int:
+    """
+    Count the documents with a category value
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        category (str): The category, "type" or "year".
+        value (str): The category value.
+
+    Returns:
+        int: The number of documents.
+    """
+    if category not in ["type", "year"]:
+        raise ValueError(f"Unknown category: {category}")
 
-def save_docs(analytiq_config: dict = {}, docs: dict = {}) -> None:
+    conn = _get_docs_db(analytiq_config)
+    count = conn.execute(f"SELECT COUNT(*) FROM docs WHERE {category} = ?", (value,)).fetchone()[0]
+    conn.close()
+    return count
+
+def add_doc(analytiq_config: dict, file_manifest: dict) -> None:
+    """
+    Add a file manifest
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        file_manifest (dict): The file manifest.
+    """
+    with _get_docs_db(analytiq_config) as conn:
+        conn.execute("INSERT INTO docs (file_name, uuid, type, year, sha256) VALUES (?, ?, ?, ?, ?)",
+                     [file_manifest[field] for field in doc_fields] + [file_manifest.get("sha256")])
+    conn.close()
+
+def update_doc(analytiq_config: dict, 
+               file_manifest: dict,
+               file_manifest_orig: dict = None) -> bool:
+    """
+    Update a file manifest
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        file_manifest (dict): The file manifest.
+        file_manifest_orig (dict, optional): The file manifest as read. If given, the update
+            is rejected if another session changed the file manifest since. Defaults to None.
+
+    Returns:
+        bool: False if the file manifest was changed by another session, and was not updated.
+    """
+    with _get_docs_db(analytiq_config) as conn:
+        if file_manifest_orig is None:
+            conn.execute("UPDATE docs SET file_name = ?, type = ?, year = ? WHERE uuid = ?",
+                         (file_manifest["file_name"], file_manifest["type"], file_manifest["year"], file_manifest["uuid"]))
+            updated = True
+        else:
+            updated = _update_doc_if_unchanged(conn, file_manifest, file_manifest_orig)
+    conn.close()
+
+    if not updated:
+        st.error(f"{file_manifest['file_name']} was changed by another session. Reload the page and try again.")
+    return updated
+
+def _update_doc_if_unchanged(conn: sqlite3.Connection, doc: dict, doc_orig: dict) -> bool:
+    """
+    Update a file manifest, only if it still has its original contents.
+    """
+    cursor = conn.execute("""UPDATE docs SET file_name = ?, type = ?, year = ? 
+                             WHERE uuid = ? AND file_name = ? AND type = ? AND year = ?""",
+                          (doc["file_name"], doc["type"], doc["year"], 
+                           doc_orig["uuid"], doc_orig["file_name"], doc_orig["type"], doc_orig["year"]))
+    return cursor.rowcount > 0
+
+def delete_doc(analytiq_config: dict, file_uuid: str) -> None:
+    """
+    Delete a file manifest
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        file_uuid (str): The file uuid.
+    """
+    with _get_docs_db(analytiq_config) as conn:
+        conn.execute("DELETE FROM docs WHERE uuid = ?", (file_uuid,))
+    conn.close()
+
+# Size of the blocks uploads are copied and hashed in, and age of abandoned staged uploads
+upload_block_size = 1024 * 1024
+upload_stale_seconds = 24 * 3600
+
+def stage_upload(analytiq_config: dict, stream) -> tuple:
+    """
+    Copy an uploaded file into the docstore upload folder in fixed size blocks, hashing it on the way.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        stream: The uploaded file, or any binary file-like object.
+
+    Returns:
+        tuple: The staged file path, and the sha256 hex digest of the file contents.
     """
-    Save the documents configuration
+    upload_dir = f"{analytiq_config['docstore']}/upload"
+    os.makedirs(upload_dir, exist_ok=True)
+
+    # Remove the uploads abandoned by closed sessions
+    now = time.time()
+    for entry in os.scandir(upload_dir):
+        if entry.name.endswith(".part") and now - entry.stat().st_mtime > upload_stale_seconds:
+            os.remove(entry.path)
+
+    staged_path = f"{upload_dir}/{uuid.uuid4()}.part"
+    sha256 = hashlib.sha256()
+    stream.seek(0)
+    with open(staged_path, "wb") as f:
+        while True:
+            block = stream.read(upload_block_size)
+            if not block:
+                break
+            sha256.update(block)
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+
+    return staged_path, sha256.hexdigest()
+
+def commit_upload(analytiq_config: dict, staged_path: str, file_manifest: dict) -> str:
+    """
+    Move a staged upload into its uuid folder.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        staged_path (str): The staged file path.
+        file_manifest (dict): The file manifest, with the file uuid and name.
+
+    Returns:
+        str: The path of the file in the docstore.
+    """
+    os.makedirs(f"{analytiq_config['docstore']}/doc/{file_manifest['uuid']}", exist_ok=True)
+    file_path = f"{analytiq_config['docstore']}/doc/{file_manifest['uuid']}/{file_manifest['file_name']}"
+    os.replace(staged_path, file_path)
+    return file_path
+
+def discard_upload(staged_path: str) -> None:
+    """
+    Remove a staged upload that will not be added to the docstore.
+    """
+    if os.path.exists(staged_path):
+        os.remove(staged_path)
+
+def save_docs(analytiq_config: dict = {}, docs: list = []) -> bool:
+    """
+    Save the documents configuration. Only the file manifests that were added, changed
+    or removed since get_docs are written.
+
+    The save is rejected if another session changed any of those file manifests since get_docs.
 
     Args:
         analytiq_config (dict, optional): The ChromaDB configuration. Defaults to {}.
-        docs (dict, optional): The documents configuration. Defaults to {}.
+        docs (list, optional): The documents configuration. Defaults to [].
+
+    Returns:
+        bool: False if the documents were changed by another session, and were not saved.
     """
-    global docs_orig
+    session_state = get_session_state()
+    docs_orig = session_state.get("docs_orig", {})
 
-    if docs == docs_orig:
-        # Documents have not changed
-        return
+    docs_new = {doc["uuid"]: doc for doc in docs}
+    upserts = [doc for id, doc in docs_new.items() if docs_orig.get(id) != doc]
+    deletes = [docs_orig[id] for id in docs_orig if id not in docs_new]
 
-    analytiq_docs = {
-        "schema_version": "1.0",
-        "docs": docs
-    }
-    fname = f"{analytiq_config['docstore']}/analytiq_docs.json"
-    json.dump(analytiq_docs, open(fname, "w"), indent=2)
-    st.info(f"Saved {fname}")
+    if len(upserts) == 0 and len(deletes) == 0:
+        # Documents have not changed
+        return True
+
+    conn = _get_docs_db(analytiq_config)
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conflict = False
+        for doc in deletes:
+            cursor = conn.execute("DELETE FROM docs WHERE uuid = ? AND file_name = ? AND type = ? AND year = ?",
+                                  [doc[field] for field in ["uuid", "file_name", "type", "year"]])
+            conflict = conflict or cursor.rowcount == 0
+        for doc in upserts:
+            if doc["uuid"] in docs_orig:
+                conflict = conflict or not _update_doc_if_unchanged(conn, doc, docs_orig[doc["uuid"]])
+            else:
+                try:
+                    conn.execute("INSERT INTO docs (file_name, uuid, type, year, sha256) VALUES (?, ?, ?, ?, ?)",
+                                 [doc[field] for field in doc_fields] + [doc.get("sha256")])
+                except sqlite3.IntegrityError:
+                    conflict = True
+        conn.execute("ROLLBACK" if conflict else "COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    if conflict:
+        st.error("The documents were changed by another session. Reload the page and try again.")
+        return False
+
+    st.info(f"Saved {len(upserts)} documents, deleted {len(deletes)} documents")
 
     # Save the original documents
-    docs_orig = copy.deepcopy(docs)
+    session_state["docs_orig"] = {id: dict(doc) for id, doc in docs_new.items()}
+    return True
 
+def normalize_doc(analytiq_config: dict, doc: dict) -> dict:
+    """
+    Normalize a file manifest, moving files without a uuid into their uuid folder
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        doc (dict): The file manifest.
+
+    Returns:
+        dict: The normalized file manifest.
+    """
+    if "uuid" not in doc:
+        file_uuid = str(uuid.uuid4())
+        # Create the uuid folder
+        os.makedirs(f"{analytiq_config['docstore']}/doc/{file_uuid}", exist_ok=True)
+        # Move the file to the uuid folder. The uuid is only set once the file is moved.
+        fname1 = f"{analytiq_config['docstore']}/{doc['file_name']}"
+        fname2 = f"{analytiq_config['docstore']}/doc/{file_uuid}/{doc['file_name']}"
+        os.rename(fname1, fname2)
+        doc["uuid"] = file_uuid
+        st.info(f"Moved {fname1} to {fname2}")
+
+    return {field: doc[field] for field in doc_fields + doc_optional_fields if field in doc}
 
 @st.cache_data
 def normalize_chroma_schema(analytiq_config: dict = {}) -> None:
@@ -252,26 +847,7 @@ def normalize_chroma_schema(analytiq_config: dict = {}) -> None:
 
     # Normalize the docs
     docs = get_docs(analytiq_config)
-    docs2 = []
-
-    for doc in docs:
-        if "uuid" not in doc:
-            doc["uuid"] = str(uuid.uuid4())
-            # Create the uuid folder
-            os.makedirs(f"{analytiq_config['docstore']}/doc/{doc['uuid']}", exist_ok=True)
-            # Move the file to the uuid folder
-            fname1 = f"{analytiq_config['docstore']}/{doc['file_name']}"
-            fname2 = f"{analytiq_config['docstore']}/doc/{doc['uuid']}/{doc['file_name']}"
-            os.rename(fname1, fname2)
-            st.info(f"Moved {fname1} to {fname2}")
-
-        # Copy into the new docs list
-        docs2.append({
-            "file_name": doc["file_name"],
-            "uuid": doc["uuid"],
-            "type": doc["type"],
-            "year": doc["year"]
-        })
+    docs2 = [normalize_doc(analytiq_config, doc) for doc in docs]
 
     # Save the docs
     save_docs(analytiq_config, docs2)
\ No newline at end of file
@@ -0,0 +1,287 @@
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from sentence_transformers import SentenceTransformer
+from langchain.embeddings import OpenAIEmbeddings
+
+# Process-wide embedding models, loaded once per model name
+_embedding_models = {}
+_embedding_locks = {}
+_embedding_models_lock = threading.Lock()
+
+# Models served by the OpenAI API rather than loaded locally
+openai_embedding_models = ["text-embedding-ada-002"]
+
+# Embedding dimension of each model, measured on first use
+_embedding_dimensions = {}
+
+# Process-wide LRU cache of query embeddings, keyed by model name and normalized query
+_query_embeddings = OrderedDict()
+_query_embeddings_lock = threading.Lock()
+
+# Process-wide embedding caches, one per docstore
+_embedding_caches = {}
+_embedding_caches_lock = threading.Lock()
+
+def get_embedding_model(model_name: str = "all-MiniLM-L6-v2") -> object:
+    """
+    Get the shared embedding model, loading it on first use.
+
+    Args:
+        model_name (str, optional): The name of the embedding model. Defaults to "all-MiniLM-L6-v2".
+
+    Returns:
+        object: The embedding model.
+    """
+    with _embedding_models_lock:
+        if model_name not in _embedding_models:
+            if model_name in openai_embedding_models:
+                model = OpenAIEmbeddings(model=model_name)
+            else:
+                model = SentenceTransformer(model_name)
+            _embedding_models[model_name] = model
+            _embedding_locks[model_name] = threading.Lock()
+
+        return _embedding_models[model_name]
+
+def embed_texts(texts: list,
+                model_name: str = "all-MiniLM-L6-v2",
+                batch_size: int = 64) -> np.ndarray:
+    """
+    Embed a list of texts with the shared embedding model.
+
+    Args:
+        texts (list): The texts to embed.
+        model_name (str, optional): The name of the embedding model. Defaults to "all-MiniLM-L6-v2".
+        batch_size (int, optional): The number of texts per model batch. Defaults to 64.
+
+    Returns:
+        np.ndarray: A float32 array with one embedding per row.
+    """
+    model = get_embedding_model(model_name)
+
+    if len(texts) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    if model_name in openai_embedding_models:
+        # The API calls do not use the local cores, so they are not serialized
+        return np.array(model.embed_documents(texts, chunk_size=batch_size), dtype=np.float32)
+
+    # Run one batch at a time per model, rather than oversubscribing the cores. The lock is
+    # released between batches, so a query waits for at most one batch of a large ingestion.
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        with _embedding_locks[model_name]:
+            embeddings.append(model.encode(texts[i:i + batch_size],
+                                           batch_size=batch_size,
+                                           convert_to_numpy=True,
+                                           show_progress_bar=False))
+
+    return np.concatenate(embeddings).astype(np.float32, copy=False)
+
+def get_embedding_dimension(model_name: str = "all-MiniLM-L6-v2") -> int:
+    """
+    Get the dimension of the embeddings of a model.
+
+    Args:
+        model_name (str, optional): The name of the embedding model. Defaults to "all-MiniLM-L6-v2".
+
+    Returns:
+        int: The embedding dimension.
+    """
+    if model_name not in _embedding_dimensions:
+        _embedding_dimensions[model_name] = embed_texts(["dimension"], model_name=model_name).shape[1]
+    return _embedding_dimensions[model_name]
+
+def embed_query(query: str,
+                model_name: str = "all-MiniLM-L6-v2",
+                cache_size: int = 1024) -> np.ndarray:
+    """
+    Embed a search query with the shared embedding model, reusing the embeddings of recent queries.
+
+    Queries are normalized by collapsing whitespace, so repeated questions hit the cache.
+
+    Args:
+        query (str): The query text.
+        model_name (str, optional): The name of the embedding model. Defaults to "all-MiniLM-L6-v2".
+        cache_size (int, optional): The max number of cached query embeddings. Defaults to 1024.
+
+    Returns:
+        np.ndarray: The float32 query embedding.
+    """
+    query = " ".join(query.split())
+    key = (model_name, query)
+    with _query_embeddings_lock:
+        if key in _query_embeddings:
+            _query_embeddings.move_to_end(key)
+            return _query_embeddings[key]
+
+    embedding = embed_texts([query], model_name=model_name)[0]
+
+    with _query_embeddings_lock:
+        _query_embeddings[key] = embedding
+        _query_embeddings.move_to_end(key)
+        while len(_query_embeddings) > max(cache_size, 0):
+            _query_embeddings.popitem(last=False)
+
+    return embedding
+
+class AnalytiqEmbeddingFunction:
+    """
+    Chroma embedding function backed by the shared embedding models.
+    """
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", batch_size: int = 64):
+        self.model_name = model_name
+        self.batch_size = batch_size
+
+    def __call__(self, input: list) -> list:
+        return embed_texts(list(input),
+                           model_name=self.model_name,
+                           batch_size=self.batch_size).tolist()
+
+class EmbeddingCache:
+    """
+    On-disk cache of chunk embeddings, keyed by a hash of the model name and chunk text.
+
+    The cache is a SQLite database. When it grows past max_bytes, the least recently
+    used embeddings are evicted.
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                key TEXT PRIMARY KEY,
+                                vector BLOB NOT NULL,
+                                nbytes INTEGER NOT NULL,
+                                last_used REAL NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, keys: list) -> dict:
+        """
+        Get the cached embeddings of the keys, and mark them as recently used.
+
+        Returns:
+            dict: Map from key to embedding, for the keys found in the cache.
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                                          batch).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+            if len(found) > 0:
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+        return found
+
+    def put(self, embeddings: dict) -> None:
+        """
+        Add embeddings to the cache, evicting the least recently used ones if it is full.
+
+        Args:
+            embeddings (dict): Map from key to embedding.
+        """
+        now = time.time()
+        with self._lock:
+            for key, embedding in embeddings.items():
+                vector = np.asarray(embedding, dtype=np.float32).tobytes()
+                cursor = self._conn.execute("INSERT OR IGNORE INTO embeddings (key, vector, nbytes, last_used) VALUES (?, ?, ?, ?)",
+                                            (key, vector, len(vector), now))
+                if cursor.rowcount > 0:
+                    self._total_bytes += len(vector)
+            self._conn.commit()
+
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """
+        Evict the least recently used embeddings, down to 90% of max_bytes.
+        """
+        # Other processes may have written to the cache as well
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+        excess = self._total_bytes - int(0.9 * self.max_bytes)
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, nbytes in self._conn.execute("SELECT key, nbytes FROM embeddings ORDER BY last_used"):
+            evicted.append((key,))
+            excess -= nbytes
+            self._total_bytes -= nbytes
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+        self._conn.commit()
+
+def get_embedding_cache(analytiq_config: dict) -> EmbeddingCache:
+    """
+    Get the shared embedding cache of the docstore.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+
+    Returns:
+        EmbeddingCache: The embedding cache, or None if the cache is disabled.
+    """
+    max_bytes = analytiq_config.get("embed_cache_mb", 0) * 1024 * 1024
+    if max_bytes <= 0:
+        return None
+
+    path = f"{analytiq_config['docstore']}/analytiq_embedding_cache.db"
+    with _embedding_caches_lock:
+        if path not in _embedding_caches:
+            _embedding_caches[path] = EmbeddingCache(path, max_bytes)
+        return _embedding_caches[path]
+
+def embed_chunks(analytiq_config: dict,
+                 texts: list,
+                 model_name: str = "all-MiniLM-L6-v2") -> np.ndarray:
+    """
+    Embed document chunks, reusing the embeddings found in the embedding cache.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        texts (list): The chunk texts to embed.
+        model_name (str, optional): The name of the embedding model. Defaults to "all-MiniLM-L6-v2".
+
+    Returns:
+        np.ndarray: A float32 array with one embedding per row.
+    """
+    batch_size = analytiq_config.get("embed_batch_size", 64)
+    cache = get_embedding_cache(analytiq_config)
+    if cache is None or len(texts) == 0:
+        return embed_texts(texts, model_name=model_name, batch_size=batch_size)
+
+    keys = [EmbeddingCache.key(model_name, text) for text in texts]
+    found = cache.get(keys)
+
+    # Embed each missing text once, even if it repeats
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in missing:
+            missing[key] = text
+    if len(missing) > 0:
+        embeddings = embed_texts(list(missing.values()), model_name=model_name, batch_size=batch_size)
+        computed = dict(zip(missing.keys(), embeddings))
+        cache.put(computed)
+        found.update(computed)
+
+    return np.stack([found[key] for key in keys])
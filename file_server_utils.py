@@ -0,0 +1,94 @@
+import os
+import asyncio
+import threading
+from urllib.parse import quote
+import tornado.web
+import tornado.ioloop
+import streamlit as st
+
+from config_utils import (
+    get_doc
+)
+
+# File servers started by this process, one per docstore
+_file_servers = set()
+_file_servers_lock = threading.Lock()
+
+class _DocFileHandler(tornado.web.StaticFileHandler):
+    """
+    Serve only the documents of the docstore, at doc/<uuid>/<file name> as in their manifest,
+    and not the parser caches or other files kept next to them.
+    """
+    def initialize(self, path: str, analytiq_config: dict = None) -> None:
+        super().initialize(path)
+        self.analytiq_config = analytiq_config
+
+    def validate_absolute_path(self, root: str, absolute_path: str):
+        parts = os.path.relpath(absolute_path, root).split(os.sep)
+        if len(parts) != 2:
+            raise tornado.web.HTTPError(404)
+        file_manifest = get_doc(self.analytiq_config, parts[0])
+        if file_manifest is None or file_manifest["file_name"] != parts[1]:
+            raise tornado.web.HTTPError(404)
+        return super().validate_absolute_path(root, absolute_path)
+
+def _serve_files(analytiq_config: dict, address: str, port: int) -> None:
+    """
+    Serve the docstore files on their own tornado event loop.
+    """
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    # StaticFileHandler answers Range requests, so PDF viewers fetch only the pages they show
+    app = tornado.web.Application([
+        (r"/doc/(.*)", _DocFileHandler, {"path": f"{analytiq_config['docstore']}/doc",
+                                         "analytiq_config": analytiq_config}),
+    ])
+    try:
+        app.listen(port, address=address)
+    except OSError as e:
+        # Another app process on this host is already serving the docstore
+        print(f"File server not started on port {port}: {e}")
+        return
+    tornado.ioloop.IOLoop.current().start()
+
+def start_file_server(analytiq_config: dict) -> None:
+    """
+    Start the docstore file server in a daemon thread, once per process.
+
+    The server binds to ANALYTIQ_FILE_SERVER_ADDRESS, or else to the address of the
+    Streamlit server (server.address), which is all interfaces by default.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+    """
+    docstore = analytiq_config["docstore"]
+    with _file_servers_lock:
+        if docstore in _file_servers:
+            return
+        _file_servers.add(docstore)
+
+    address = analytiq_config.get("file_server_address") or st.get_option("server.address") or ""
+    threading.Thread(target=_serve_files,
+                     args=(analytiq_config, address, analytiq_config["file_server_port"]),
+                     name="analytiq-file-server",
+                     daemon=True).start()
+
+def get_file_url(analytiq_config: dict, file_manifest: dict) -> str:
+    """
+    Get the file server URL of a docstore file.
+
+    Without ANALYTIQ_FILE_SERVER_URL, the file server is assumed on the host the browser
+    reaches Streamlit at (browser.serverAddress).
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        file_manifest (dict): The file manifest, or chunk metadata, with the file uuid and name.
+
+    Returns:
+        str: The URL of the file.
+    """
+    base_url = analytiq_config.get("file_server_url")
+    if not base_url:
+        host = st.get_option("browser.serverAddress") or "localhost"
+        base_url = f"http://{host}:{analytiq_config['file_server_port']}"
+    base_url = base_url.rstrip("/")
+    return f"{base_url}/doc/{file_manifest['uuid']}/{quote(file_manifest['file_name'])}"
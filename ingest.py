@@ -0,0 +1,180 @@
+"""
+Headless ingestion of docstore files into Chroma collections.
+
+Usage:
+    python ingest.py upload COLLECTION      Ingest all docstore files not yet in the collection
+    python ingest.py reingest COLLECTION    Queue the work to bring the collection up to date with its settings
+    python ingest.py resume JOB_ID          Resume an interrupted job
+    python ingest.py retry JOB_ID           Retry the failed files of a job
+    python ingest.py status [JOB_ID]        List the jobs, or show the files of a job
+    python ingest.py worker [--once]        Process the jobs queued by the Upload page
+"""
+import sys
+import argparse
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+from config_utils import (
+    load_analytiq_config,
+    get_collections,
+    get_docs,
+)
+from chroma_utils import (
+    check_chroma_files
+)
+from ingest_utils import (
+    create_ingest_job,
+    get_ingest_job,
+    list_ingest_jobs,
+    run_ingest_job,
+    run_ingest_worker,
+    schedule_collection_reingest
+)
+
+def run_job(analytiq_config: dict, job_id: str, retry_failed: bool = False) -> int:
+    """
+    Run an ingestion job with a progress bar, and return the process exit code.
+    """
+    analytiq_collections = get_collections(analytiq_config=analytiq_config)
+    analytiq_docs = get_docs(analytiq_config=analytiq_config)
+
+    job = get_ingest_job(analytiq_config, job_id)
+    if job is None:
+        print(f"Unknown job {job_id}", file=sys.stderr)
+        return 1
+    if retry_failed:
+        n_files = len([f for f in job["files"] if f["state"] == "failed"])
+    else:
+        n_files = len([f for f in job["files"] if f["state"] not in ["uploaded", "failed"]])
+
+    print(f"Job {job_id}: {n_files} files to ingest into {job['collection_name']}")
+    with tqdm(total=n_files, desc=f"Uploading files to {job['collection_name']}") as progress_bar:
+        def progress_callback(file_manifest, n_chunks, error):
+            if error is not None:
+                tqdm.write(f"Failed to upload {file_manifest['file_name']}: {error}")
+            progress_bar.update(1)
+
+        result = run_ingest_job(analytiq_config=analytiq_config,
+                                analytiq_collections=analytiq_collections,
+                                analytiq_docs=analytiq_docs,
+                                job_id=job_id,
+                                retry_failed=retry_failed,
+                                progress_callback=progress_callback)
+
+    print(f"Uploaded {len(result['uploaded'])} files, {len(result['failed'])} failed")
+    return 1 if len(result["failed"]) > 0 else 0
+
+def upload(analytiq_config: dict, collection_name: str) -> int:
+    """
+    Create and run a job ingesting all the files not yet in the collection.
+    """
+    analytiq_collections = get_collections(analytiq_config=analytiq_config)
+    analytiq_docs = get_docs(analytiq_config=analytiq_config)
+
+    if collection_name not in analytiq_collections:
+        print(f"Unknown collection {collection_name}", file=sys.stderr)
+        return 1
+
+    file_collections = check_chroma_files(analytiq_config=analytiq_config,
+                                          analytiq_collections={collection_name: analytiq_collections[collection_name]},
+                                          file_manifests=analytiq_docs)
+    file_manifests = [file_manifest for file_manifest in analytiq_docs
+                      if collection_name not in file_collections[file_manifest["uuid"]]]
+
+    job_id = create_ingest_job(analytiq_config, collection_name, file_manifests)
+    return run_job(analytiq_config, job_id)
+
+def reingest(analytiq_config: dict, collection_name: str) -> int:
+    """
+    Queue the reingestion of the collection files made with older settings, for the worker.
+    """
+    analytiq_collections = get_collections(analytiq_config=analytiq_config)
+    if collection_name not in analytiq_collections:
+        print(f"Unknown collection {collection_name}", file=sys.stderr)
+        return 1
+
+    plan = schedule_collection_reingest(analytiq_config=analytiq_config,
+                                        collection_name=collection_name,
+                                        collection=analytiq_collections[collection_name],
+                                        analytiq_docs=get_docs(analytiq_config=analytiq_config))
+    if len(plan) == 0:
+        print(f"{collection_name} is up to date")
+    for stage in set(plan.values()):
+        print(f"Queued {stage} of {list(plan.values()).count(stage)} files of {collection_name}")
+    return 0
+
+def status(analytiq_config: dict, job_id: str = None) -> int:
+    """
+    Print the jobs, or the files of one job.
+    """
+    if job_id is None:
+        for job in list_ingest_jobs(analytiq_config):
+            counts = ", ".join(f"{state} {count}" for state, count in job["counts"].items() if count > 0)
+            print(f"{job['job_id']}  {job['collection_name']}  {job['stage'] or 'upload'}  {job['status']}  {counts}")
+        return 0
+
+    job = get_ingest_job(analytiq_config, job_id)
+    if job is None:
+        print(f"Unknown job {job_id}", file=sys.stderr)
+        return 1
+    print(f"{job['job_id']}  {job['collection_name']}  {job['status']}")
+    for job_file in job["files"]:
+        error = f"  {job_file['error']}" if job_file["error"] else ""
+        print(f"  {job_file['state']:<9} {job_file['file_name']}{error}")
+    return 0
+
+def worker(analytiq_config: dict, once: bool = False) -> int:
+    """
+    Process the queued ingestion jobs.
+    """
+    def progress_callback(file_manifest, n_chunks, error):
+        if error is not None:
+            print(f"Failed to upload {file_manifest['file_name']}: {error}", file=sys.stderr)
+        else:
+            print(f"Uploaded {file_manifest['file_name']} ({n_chunks} chunks)")
+
+    print("Waiting for ingestion jobs" if not once else "Processing queued ingestion jobs")
+    try:
+        run_ingest_worker(analytiq_config, once=once, progress_callback=progress_callback)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Ingest docstore files into Chroma collections.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    upload_parser = subparsers.add_parser("upload", help="Ingest all docstore files not yet in a collection")
+    upload_parser.add_argument("collection", help="The collection name")
+    reingest_parser = subparsers.add_parser("reingest", help="Queue the work to bring a collection up to date with its settings")
+    reingest_parser.add_argument("collection", help="The collection name")
+    resume_parser = subparsers.add_parser("resume", help="Resume an interrupted job")
+    resume_parser.add_argument("job_id", help="The job id")
+    retry_parser = subparsers.add_parser("retry", help="Retry the failed files of a job")
+    retry_parser.add_argument("job_id", help="The job id")
+    status_parser = subparsers.add_parser("status", help="List the jobs, or show the files of a job")
+    status_parser.add_argument("job_id", nargs="?", help="The job id")
+    worker_parser = subparsers.add_parser("worker", help="Process the jobs queued by the Upload page")
+    worker_parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+
+    args = parser.parse_args()
+
+    # Load the environment variables from the top level .env file
+    load_dotenv()
+    analytiq_config = load_analytiq_config()
+
+    if args.command == "upload":
+        return upload(analytiq_config, args.collection)
+    elif args.command == "reingest":
+        return reingest(analytiq_config, args.collection)
+    elif args.command == "resume":
+        return run_job(analytiq_config, args.job_id)
+    elif args.command == "retry":
+        return run_job(analytiq_config, args.job_id, retry_failed=True)
+    elif args.command == "worker":
+        return worker(analytiq_config, once=args.once)
+    else:
+        return status(analytiq_config, args.job_id)
+
+if __name__ == "__main__":
+    sys.exit(main())
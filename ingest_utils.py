@@ -0,0 +1,860 @@
+import os
+import time
+import uuid
+import socket
+import traceback
+import queue
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from config_utils import (
+    get_collections,
+    get_docs
+)
+from collection_utils import (
+    load_collection_docs,
+    get_collection_splitter,
+    get_splitter_key,
+    get_collection_fingerprint
+)
+from chroma_utils import (
+    get_chunk_ids,
+    get_chroma_file_metadatas,
+    get_chroma_fingerprints,
+    check_chroma_embeddings,
+    reset_chroma_collection,
+    upsert_chroma_file_chunks
+)
+from embedding_utils import (
+    embed_chunks
+)
+
+# Marks the end of the stream of files in a stage queue
+_END = None
+
+# The states of a file in an ingestion job, in pipeline order
+ingest_file_states = ["pending", "parsed", "split", "embedded", "uploaded", "failed"]
+
+# Parse process pool shared by the ingestion jobs of the process
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+# Seconds after its last heartbeat that a running job counts as abandoned, and is queued again
+ingest_lease_seconds = 60
+# The jobs a runner holds a live lease on. Superseded jobs keep running until their next file.
+_live_lease_condition = "status IN ('running', 'superseded') AND heartbeat_at >= ?"
+
+# The stages a collection configuration change reruns, cheapest first. Each reruns the stages after it.
+reingest_stages = ["resplit", "reparse", "reembed"]
+
+def _notify(state_callback, file_manifest: dict, state: str, error=None) -> None:
+    """
+    Report the new state of a file, if there is a state callback.
+    """
+    if state_callback is not None:
+        state_callback(file_manifest, state, error)
+
+def _parse_file(analytiq_config: dict, collection: dict, file_manifest: dict) -> list:
+    """
+    Parse a file. Runs in a worker process of the parse pool.
+    """
+    return load_collection_docs(analytiq_config=analytiq_config,
+                                collection=collection,
+                                file_manifest=file_manifest)
+
+def _put(q: queue.Queue, item, stop_event: threading.Event) -> bool:
+    """
+    Put an item on a bounded queue, giving up if the pipeline is stopped.
+
+    Returns:
+        bool: True if the item was queued.
+    """
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get_parse_pool(analytiq_config: dict, broken_pool: ProcessPoolExecutor = None) -> ProcessPoolExecutor:
+    """
+    Get the parse process pool of the process, so that parse_workers caps the parse processes
+    of all the ingestion jobs running at once.
+
+    The processes are spawned rather than forked, since forking the multithreaded app process
+    with torch initialized can deadlock.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        broken_pool (ProcessPoolExecutor, optional): A pool found broken, replaced by a new pool. Defaults to None.
+
+    Returns:
+        ProcessPoolExecutor: The parse pool.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None or _parse_pool is broken_pool:
+            if _parse_pool is not None:
+                _parse_pool.shutdown(wait=False)
+            _parse_pool = ProcessPoolExecutor(max_workers=max(1, analytiq_config.get("parse_workers", 1)),
+                                              mp_context=multiprocessing.get_context("spawn"))
+        return _parse_pool
+
+def _parse_stage(analytiq_config: dict,
+                 collection: dict,
+                 file_manifests: list,
+                 split_queue: queue.Queue,
+                 stop_event: threading.Event,
+                 state_callback=None) -> None:
+    """
+    Parse the files in the shared parse pool, and pass the parsed documents to the split stage.
+    """
+    parse_workers = max(1, analytiq_config.get("parse_workers", 1))
+
+    try:
+        executor = _get_parse_pool(analytiq_config)
+        pending = {}
+        file_iter = iter(file_manifests)
+        while not stop_event.is_set():
+            # Keep the pool busy, without running far ahead of the split stage
+            while len(pending) < 2 * parse_workers:
+                file_manifest = next(file_iter, None)
+                if file_manifest is None:
+                    break
+                try:
+                    future = executor.submit(_parse_file, analytiq_config, collection, file_manifest)
+                except BrokenProcessPool:
+                    # A parse process died, e.g. out of memory. Start a new pool.
+                    executor = _get_parse_pool(analytiq_config, broken_pool=executor)
+                    future = executor.submit(_parse_file, analytiq_config, collection, file_manifest)
+                pending[future] = file_manifest
+
+            if len(pending) == 0:
+                break
+
+            done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_manifest = pending.pop(future)
+                try:
+                    item = (file_manifest, future.result(), None)
+                    _notify(state_callback, file_manifest, "parsed")
+                except Exception as e:
+                    item = (file_manifest, None, e)
+                if not _put(split_queue, item, stop_event):
+                    break
+
+        if stop_event.is_set():
+            for future in pending:
+                future.cancel()
+    finally:
+        _put(split_queue, _END, stop_event)
+
+def _split_stage(splitter,
+                 split_queue: queue.Queue,
+                 embed_queue: queue.Queue,
+                 stop_event: threading.Event,
+                 state_callback=None) -> None:
+    """
+    Split the parsed documents into chunks, and pass them to the embed stage.
+    """
+    try:
+        while not stop_event.is_set():
+            try:
+                item = split_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _END:
+                break
+
+            file_manifest, docs, error = item
+            split_docs = None
+            if error is None:
+                try:
+                    split_docs = splitter.split_documents(docs)
+                    _notify(state_callback, file_manifest, "split")
+                except Exception as e:
+                    error = e
+            if not _put(embed_queue, (file_manifest, split_docs, error), stop_event):
+                break
+    finally:
+        _put(embed_queue, _END, stop_event)
+
+def _embed_stage(analytiq_config: dict,
+                 collection_name: str,
+                 collection: dict,
+                 embed_queue: queue.Queue,
+                 upload_queue: queue.Queue,
+                 stop_event: threading.Event,
+                 state_callback=None) -> None:
+    """
+    Embed the new chunks with the shared embedding model, and pass them to the upload stage.
+
+    Chunks already stored in the collection under the same content-defined id are not embedded again.
+    """
+    splitter_key = get_splitter_key(collection)
+    try:
+        while not stop_event.is_set():
+            try:
+                item = embed_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _END:
+                break
+
+            file_manifest, split_docs, error = item
+            chunk_ids = None
+            file_chunks = None
+            embeddings = None
+            if error is None:
+                try:
+                    file_chunks = [doc.page_content for doc in split_docs]
+                    chunk_ids = get_chunk_ids(file_manifest["uuid"], splitter_key, file_chunks)
+                    stored = get_chroma_file_metadatas(analytiq_config=analytiq_config,
+                                                       collection_name=collection_name,
+                                                       file_uuid=file_manifest["uuid"])
+                    new_idx = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in stored]
+                    embeddings = {}
+                    if len(new_idx) > 0:
+                        vectors = embed_chunks(analytiq_config=analytiq_config,
+                                               texts=[file_chunks[i] for i in new_idx],
+                                               model_name=collection["embedding"])
+                        embeddings = dict(zip([chunk_ids[i] for i in new_idx], vectors))
+                    _notify(state_callback, file_manifest, "embedded")
+                except Exception as e:
+                    error = e
+            if not _put(upload_queue, (file_manifest, chunk_ids, file_chunks, embeddings, error), stop_event):
+                break
+    finally:
+        _put(upload_queue, _END, stop_event)
+
+def run_ingest_pipeline(analytiq_config: dict,
+                        collection_name: str,
+                        collection: dict,
+                        file_manifests: list,
+                        progress_callback=None,
+                        state_callback=None,
+                        cancel_event: threading.Event = None) -> dict:
+    """
+    Ingest files into a collection with a staged pipeline.
+
+    Files are parsed in the process-wide parse pool, split and embedded in background threads,
+    and uploaded to Chroma on the calling thread. The stages are connected by bounded queues, so
+    a slow stage applies back pressure instead of buffering whole parsed files.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        collection (dict): The collection configuration.
+        file_manifests (list): The manifests of the files to ingest.
+        progress_callback (callable, optional): Called on the calling thread as
+            progress_callback(file_manifest, n_chunks, error) after each file. Defaults to None.
+        state_callback (callable, optional): Called from the stage threads as
+            state_callback(file_manifest, state, error) as a file moves through the stages. Defaults to None.
+        cancel_event (threading.Event, optional): Stops the ingestion before the next upload when set.
+            Defaults to None.
+
+    Returns:
+        dict: The uuids of the files "uploaded", and the errors of the files "failed", keyed by uuid.
+    """
+    queue_size = max(1, analytiq_config.get("ingest_queue_size", 8))
+    split_queue = queue.Queue(maxsize=queue_size)
+    embed_queue = queue.Queue(maxsize=queue_size)
+    upload_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+
+    # Get the splitter up front, so that configuration errors are raised to the caller
+    splitter = get_collection_splitter(analytiq_config=analytiq_config,
+                                       collection=collection)
+    fingerprint = get_collection_fingerprint(collection)
+
+    threads = [
+        threading.Thread(target=_parse_stage,
+                         args=(analytiq_config, collection, file_manifests, split_queue, stop_event, state_callback),
+                         daemon=True),
+        threading.Thread(target=_split_stage,
+                         args=(splitter, split_queue, embed_queue, stop_event, state_callback),
+                         daemon=True),
+        threading.Thread(target=_embed_stage,
+                         args=(analytiq_config, collection_name, collection, embed_queue, upload_queue, stop_event, state_callback),
+                         daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    result = {"uploaded": [], "failed": {}}
+    try:
+        while True:
+            item = upload_queue.get()
+            if item is _END or (cancel_event is not None and cancel_event.is_set()):
+                break
+
+            file_manifest, chunk_ids, file_chunks, embeddings, error = item
+            n_chunks = 0
+            if error is None:
+                try:
+                    # Only the chunks that changed since the last upload of the file are written
+                    upsert_chroma_file_chunks(analytiq_config=analytiq_config,
+                                              collection_name=collection_name,
+                                              file_manifest=file_manifest,
+                                              chunk_ids=chunk_ids,
+                                              file_chunks=file_chunks,
+                                              embedding=collection["embedding"],
+                                              embeddings=embeddings,
+                                              fingerprint=fingerprint)
+                    n_chunks = len(file_chunks)
+                except Exception as e:
+                    error = e
+
+            if error is None:
+                result["uploaded"].append(file_manifest["uuid"])
+                _notify(state_callback, file_manifest, "uploaded")
+            else:
+                result["failed"][file_manifest["uuid"]] = str(error)
+                _notify(state_callback, file_manifest, "failed", error)
+
+            if progress_callback is not None:
+                progress_callback(file_manifest, n_chunks, error)
+    finally:
+        # Stop the stages if we exit early
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+    return result
+
+def _get_jobs_db(analytiq_config: dict) -> sqlite3.Connection:
+    """
+    Open the ingestion job journal, kept in analytiq_jobs.db in the docstore.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+
+    Returns:
+        sqlite3.Connection: A connection to the journal.
+    """
+    conn = sqlite3.connect(f"{analytiq_config['docstore']}/analytiq_jobs.db", timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            collection_name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            stage TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS job_files (
+            job_id TEXT NOT NULL,
+            uuid TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            state TEXT NOT NULL,
+            error TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (job_id, uuid)
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+    """)
+
+    # Add the reingest stage and the lease of the runner to journals created before them
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+    for column, column_type in [("stage", "TEXT"), ("worker_id", "TEXT"), ("heartbeat_at", "REAL")]:
+        if column not in columns:
+            with conn:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+    return conn
+
+def create_ingest_job(analytiq_config: dict,
+                      collection_name: str,
+                      file_manifests: list,
+                      status: str = "created",
+                      stage: str = None) -> str:
+    """
+    Create an ingestion job in the journal, with all files pending.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        file_manifests (list): The manifests of the files to ingest.
+        status (str, optional): The job status. Use "queued" to hand the job to an
+            ingestion worker. Defaults to "created".
+        stage (str, optional): The reingest stage of a job scheduled by a collection
+            configuration change, one of reingest_stages. Defaults to None.
+
+    Returns:
+        str: The job id.
+    """
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    with _get_jobs_db(analytiq_config) as conn:
+        conn.execute("INSERT INTO jobs (job_id, collection_name, status, stage, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (job_id, collection_name, status, stage, now, now))
+        conn.executemany("INSERT INTO job_files (job_id, uuid, file_name, state, updated_at) VALUES (?, ?, ?, ?, ?)",
+                         [(job_id, file_manifest["uuid"], file_manifest["file_name"], "pending", now)
+                          for file_manifest in file_manifests])
+    conn.close()
+    return job_id
+
+def get_ingest_job(analytiq_config: dict, job_id: str) -> dict:
+    """
+    Get an ingestion job and the state of its files.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        job_id (str): The job id.
+
+    Returns:
+        dict: The job, with its "files", or None if there is no such job.
+    """
+    conn = _get_jobs_db(analytiq_config)
+    row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if row is None:
+        conn.close()
+        return None
+    job = dict(row)
+    job["files"] = [dict(file_row) for file_row in 
+                    conn.execute("SELECT uuid, file_name, state, error, updated_at FROM job_files WHERE job_id = ? ORDER BY rowid",
+                                 (job_id,))]
+    conn.close()
+    return job
+
+def list_ingest_jobs(analytiq_config: dict, collection_name: str = None) -> list:
+    """
+    List the ingestion jobs, most recent first, with a count of files per state.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str, optional): Only list the jobs of this collection. Defaults to None.
+
+    Returns:
+        list: The jobs.
+    """
+    conn = _get_jobs_db(analytiq_config)
+    if collection_name is None:
+        rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC").fetchall()
+    else:
+        rows = conn.execute("SELECT * FROM jobs WHERE collection_name = ? ORDER BY created_at DESC",
+                            (collection_name,)).fetchall()
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job["counts"] = {state: 0 for state in ingest_file_states}
+        for state, count in conn.execute("SELECT state, COUNT(*) FROM job_files WHERE job_id = ? GROUP BY state",
+                                         (job["job_id"],)):
+            job["counts"][state] = count
+        jobs.append(job)
+    conn.close()
+    return jobs
+
+def set_ingest_job_status(analytiq_config: dict, job_id: str, status: str) -> None:
+    """
+    Set the status of an ingestion job.
+    """
+    with _get_jobs_db(analytiq_config) as conn:
+        conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?",
+                     (status, time.time(), job_id))
+    conn.close()
+
+def set_ingest_file_state(analytiq_config: dict,
+                          job_id: str,
+                          file_uuid: str,
+                          state: str,
+                          error: str = None) -> None:
+    """
+    Record the state of a file in an ingestion job.
+    """
+    with _get_jobs_db(analytiq_config) as conn:
+        conn.execute("UPDATE job_files SET state = ?, error = ?, updated_at = ? WHERE job_id = ? AND uuid = ?",
+                     (state, error, time.time(), job_id, file_uuid))
+    conn.close()
+
+def get_ingest_worker_id() -> str:
+    """
+    Get the id of the calling thread, as the runner of an ingestion job.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+def check_ingest_job_lease(job: dict) -> bool:
+    """
+    Return True if the job is running and its runner sent a heartbeat within the lease.
+    """
+    return (job["status"] == "running" and job.get("heartbeat_at") is not None
+            and time.time() - job["heartbeat_at"] < ingest_lease_seconds)
+
+def _heartbeat_ingest_job(analytiq_config: dict, job_id: str, worker_id: str,
+                          stop_event: threading.Event, cancel_event: threading.Event) -> None:
+    """
+    Renew the lease of a running job until stopped. If the job was superseded, or another runner
+    took it over, the lease is still renewed, and cancel_event is set to stop the run.
+    """
+    while not stop_event.wait(ingest_lease_seconds / 3):
+        try:
+            with _get_jobs_db(analytiq_config) as conn:
+                cursor = conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND worker_id = ? AND status = 'running'",
+                                      (time.time(), job_id, worker_id))
+                if cursor.rowcount == 0:
+                    cancel_event.set()
+                    conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND worker_id = ?",
+                                 (time.time(), job_id, worker_id))
+            conn.close()
+        except sqlite3.Error:
+            traceback.print_exc()
+
+def run_ingest_job(analytiq_config: dict,
+                   analytiq_collections: dict,
+                   analytiq_docs: list,
+                   job_id: str,
+                   retry_failed: bool = False,
+                   progress_callback=None,
+                   worker_id: str = None) -> dict:
+    """
+    Run, resume or retry an ingestion job, recording the progress of each file in the journal.
+
+    A run picks up every file that is not uploaded or failed yet. A retry only picks up
+    the failed files. The runner holds a lease on the job while it runs, renewed by a heartbeat,
+    so that the job is queued again if the runner dies. A superseded job stops at the next file.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        analytiq_collections (dict): The collections configuration.
+        analytiq_docs (list): The documents configuration.
+        job_id (str): The job id.
+        retry_failed (bool, optional): If True, only retry the failed files. Defaults to False.
+        progress_callback (callable, optional): Passed on to run_ingest_pipeline. Defaults to None.
+        worker_id (str, optional): The id of the runner. Defaults to the id of the calling thread.
+
+    Returns:
+        dict: The uuids of the files "uploaded", and the errors of the files "failed", keyed by uuid.
+    """
+    job = get_ingest_job(analytiq_config, job_id)
+    if job is None:
+        raise ValueError(f"Unknown ingestion job: {job_id}")
+
+    collection_name = job["collection_name"]
+    if collection_name not in analytiq_collections:
+        raise ValueError(f"Unknown collection: {collection_name}")
+    collection = analytiq_collections[collection_name]
+
+    if job["stage"] == "reembed":
+        # Rebuild the collection for the new embedding, unless a resumed job already did
+        if not check_chroma_embeddings(analytiq_config, collection_name, collection["embedding"],
+                                       get_collection_fingerprint(collection)["embed_fp"]):
+            reset_chroma_collection(analytiq_config=analytiq_config,
+                                    analytiq_collections=analytiq_collections,
+                                    collection_name=collection_name)
+
+    docs_by_uuid = {file_manifest["uuid"]: file_manifest for file_manifest in analytiq_docs}
+
+    file_manifests = []
+    for job_file in job["files"]:
+        if retry_failed:
+            if job_file["state"] != "failed":
+                continue
+        elif job_file["state"] in ["uploaded", "failed"]:
+            continue
+
+        file_manifest = docs_by_uuid.get(job_file["uuid"])
+        if file_manifest is None:
+            set_ingest_file_state(analytiq_config, job_id, job_file["uuid"], "failed", "File is not in the docstore")
+            continue
+
+        # An interrupted upload is simply redone, since the chunk upserts are idempotent
+        file_manifests.append(file_manifest)
+
+    def state_callback(file_manifest, state, error):
+        set_ingest_file_state(analytiq_config, job_id, file_manifest["uuid"], state,
+                              None if error is None else str(error))
+
+    if worker_id is None:
+        worker_id = get_ingest_worker_id()
+    with _get_jobs_db(analytiq_config) as conn:
+        now = time.time()
+        conn.execute("UPDATE jobs SET status = 'running', worker_id = ?, heartbeat_at = ?, updated_at = ? WHERE job_id = ?",
+                     (worker_id, now, now, job_id))
+    conn.close()
+    stop_heartbeat = threading.Event()
+    cancel_event = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat_ingest_job,
+                                 args=(analytiq_config, job_id, worker_id, stop_heartbeat, cancel_event),
+                                 name=f"ingest-heartbeat-{job_id[:8]}",
+                                 daemon=True)
+    heartbeat.start()
+    try:
+        result = run_ingest_pipeline(analytiq_config=analytiq_config,
+                                     collection_name=collection_name,
+                                     collection=collection,
+                                     file_manifests=file_manifests,
+                                     progress_callback=progress_callback,
+                                     state_callback=state_callback,
+                                     cancel_event=cancel_event)
+    except BaseException:
+        set_ingest_job_status(analytiq_config, job_id, "interrupted")
+        raise
+    finally:
+        stop_heartbeat.set()
+        heartbeat.join()
+        # Release the lease, so that the next job of the collection can be claimed
+        with _get_jobs_db(analytiq_config) as conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = NULL WHERE job_id = ? AND worker_id = ?",
+                         (job_id, worker_id))
+        conn.close()
+
+    if cancel_event.is_set():
+        # The job was superseded by a newer reingest of the collection
+        return result
+
+    job = get_ingest_job(analytiq_config, job_id)
+    if any(job_file["state"] == "failed" for job_file in job["files"]):
+        set_ingest_job_status(analytiq_config, job_id, "failed")
+    else:
+        set_ingest_job_status(analytiq_config, job_id, "done")
+
+    return result
+
+def enqueue_ingest_job(analytiq_config: dict,
+                       collection_name: str,
+                       file_manifests: list) -> str:
+    """
+    Queue an ingestion job for an ingestion worker.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        file_manifests (list): The manifests of the files to ingest.
+
+    Returns:
+        str: The job id.
+    """
+    return create_ingest_job(analytiq_config, collection_name, file_manifests, status="queued")
+
+def plan_collection_reingest(analytiq_config: dict,
+                             collection_name: str,
+                             collection: dict) -> dict:
+    """
+    Plan the work to bring the chunks of a collection up to date with its configuration.
+
+    The fingerprints stored with the chunks of each file are compared to the collection
+    fingerprint. A new parser or parser version reparses a file, new splitter settings
+    resplit it, and a new embedding, or stored vectors of another dimension, re-embed the
+    whole collection. Other chunks stored before fingerprinting are reparsed.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        collection (dict): The collection configuration.
+
+    Returns:
+        dict: The reingest stage of each file uuid of the collection, for the files not up to date.
+    """
+    fingerprint = get_collection_fingerprint(collection)
+    stored = get_chroma_fingerprints(analytiq_config, collection_name)
+
+    # The new embedding cannot share the vector index of the old one
+    if not check_chroma_embeddings(analytiq_config, collection_name, collection["embedding"], fingerprint["embed_fp"]):
+        return {file_uuid: "reembed" for file_uuid in stored}
+
+    plan = {}
+    for file_uuid, file_fingerprints in stored.items():
+        for file_fingerprint in file_fingerprints:
+            if file_fingerprint.get("parse_fp") != fingerprint["parse_fp"]:
+                stage = "reparse"
+            elif file_fingerprint.get("split_fp") != fingerprint["split_fp"]:
+                stage = "resplit"
+            else:
+                continue
+            plan[file_uuid] = max(plan.get(file_uuid, stage), stage, key=reingest_stages.index)
+    return plan
+
+def schedule_collection_reingest(analytiq_config: dict,
+                                 collection_name: str,
+                                 collection: dict,
+                                 analytiq_docs: list) -> dict:
+    """
+    Plan the reingestion of a collection after a configuration change, and queue it for
+    the ingestion workers. The queued reingest jobs of the collection that have not started
+    are replaced, and the running ones are superseded, so that they stop at their next file.
+
+    A re-embedding rebuilds the Chroma collection right away, so that the Chat page and new
+    uploads never query or write the old vector index with the new embedding. The collection
+    is empty until the queued job has re-embedded its files. While a job of the collection is
+    still running, the queued job rebuilds the collection when it starts instead.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        collection_name (str): The name of the collection.
+        collection (dict): The collection configuration.
+        analytiq_docs (list): The documents configuration.
+
+    Returns:
+        dict: The plan, from plan_collection_reingest, for the files still in the docstore.
+    """
+    plan = plan_collection_reingest(analytiq_config, collection_name, collection)
+    file_manifests = [file_manifest for file_manifest in analytiq_docs if file_manifest["uuid"] in plan]
+    plan = {file_manifest["uuid"]: plan[file_manifest["uuid"]] for file_manifest in file_manifests}
+
+    # The first delete takes the write lock, so no worker claims the jobs in between
+    queued_jobs = "SELECT job_id FROM jobs WHERE collection_name = ? AND status = 'queued' AND stage IS NOT NULL"
+    with _get_jobs_db(analytiq_config) as conn:
+        conn.execute(f"DELETE FROM job_files WHERE job_id IN ({queued_jobs})", (collection_name,))
+        conn.execute(f"DELETE FROM jobs WHERE job_id IN ({queued_jobs})", (collection_name,))
+        conn.execute("""UPDATE jobs SET status = 'superseded', updated_at = ?
+                        WHERE collection_name = ? AND status = 'running' AND stage IS NOT NULL""",
+                     (time.time(), collection_name))
+        running = _check_ingest_collection_running(conn, collection_name)
+    conn.close()
+
+    if "reembed" in plan.values() and not running:
+        reset_chroma_collection(analytiq_config=analytiq_config,
+                                analytiq_collections={collection_name: collection},
+                                collection_name=collection_name)
+
+    if len(file_manifests) > 0:
+        create_ingest_job(analytiq_config, collection_name, file_manifests, status="queued",
+                          stage=max(plan.values(), key=reingest_stages.index))
+    return plan
+
+def _check_ingest_collection_running(conn: sqlite3.Connection, collection_name: str) -> bool:
+    """
+    Return True if a runner holds a live lease on a job of the collection, superseded or not.
+    """
+    row = conn.execute(f"""SELECT 1 FROM jobs WHERE collection_name = ? AND {_live_lease_condition}""",
+                       (collection_name, time.time() - ingest_lease_seconds)).fetchone()
+    return row is not None
+
+
+def claim_ingest_job(analytiq_config: dict, worker_id: str) -> str:
+    """
+    Claim the oldest queued ingestion job, marking it as running under the lease of the worker.
+    Safe to call from several workers and processes at once.
+
+    The running jobs whose lease expired, because their runner died or the app restarted
+    mid-job, are queued again first. The jobs of a collection that already has a job
+    running are skipped, so that the jobs of a collection run one at a time.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        worker_id (str): The id of the worker.
+
+    Returns:
+        str: The job id, or None if no queued job can be claimed.
+    """
+    conn = _get_jobs_db(analytiq_config)
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        conn.execute("""UPDATE jobs SET status = 'queued', worker_id = NULL, updated_at = ?
+                        WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)""",
+                     (now, now - ingest_lease_seconds))
+        row = conn.execute(f"""SELECT job_id FROM jobs WHERE status = 'queued' AND collection_name NOT IN
+                               (SELECT collection_name FROM jobs WHERE {_live_lease_condition})
+                               ORDER BY created_at LIMIT 1""",
+                           (now - ingest_lease_seconds,)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute("UPDATE jobs SET status = 'running', worker_id = ?, heartbeat_at = ?, updated_at = ? WHERE job_id = ?",
+                     (worker_id, now, now, row["job_id"]))
+        conn.execute("COMMIT")
+        return row["job_id"]
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def get_file_ingest_jobs(analytiq_config: dict, file_uuid: str) -> list:
+    """
+    Get the ingestion jobs of a file, most recent first, with the state of the file in each job.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        file_uuid (str): The file uuid.
+
+    Returns:
+        list: The jobs.
+    """
+    conn = _get_jobs_db(analytiq_config)
+    rows = conn.execute("""SELECT jobs.job_id, jobs.collection_name, jobs.status, jobs.heartbeat_at,
+                                  job_files.state, job_files.error, job_files.updated_at
+                           FROM job_files JOIN jobs ON jobs.job_id = job_files.job_id
+                           WHERE job_files.uuid = ? ORDER BY jobs.created_at DESC""",
+                        (file_uuid,)).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def run_ingest_worker(analytiq_config: dict,
+                      poll_interval: float = 2.0,
+                      stop_event: threading.Event = None,
+                      once: bool = False,
+                      progress_callback=None) -> None:
+    """
+    Process queued ingestion jobs until stopped.
+
+    The collections and docs are re-read before each job, so the worker sees the
+    files and collections added since it started.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+        poll_interval (float, optional): Seconds to wait when the queue is empty. Defaults to 2.0.
+        stop_event (threading.Event, optional): Stops the worker when set. Defaults to None.
+        once (bool, optional): If True, return when the queue is empty. Defaults to False.
+        progress_callback (callable, optional): Passed on to run_ingest_pipeline. Defaults to None.
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    worker_id = get_ingest_worker_id()
+    while not stop_event.is_set():
+        job_id = claim_ingest_job(analytiq_config, worker_id)
+        if job_id is None:
+            if once:
+                return
+            stop_event.wait(poll_interval)
+            continue
+
+        try:
+            run_ingest_job(analytiq_config=analytiq_config,
+                           analytiq_collections=get_collections(analytiq_config=analytiq_config),
+                           analytiq_docs=get_docs(analytiq_config=analytiq_config),
+                           job_id=job_id,
+                           progress_callback=progress_callback,
+                           worker_id=worker_id)
+        except Exception:
+            # Keep the worker alive. The journal records which files did not finish.
+            traceback.print_exc()
+            set_ingest_job_status(analytiq_config, job_id, "failed")
+
+# Ingestion worker threads started in this process, by docstore
+_ingest_workers = {}
+_ingest_workers_lock = threading.Lock()
+
+def start_ingest_worker(analytiq_config: dict) -> None:
+    """
+    Start the pool of ingestion worker threads in this process, unless it is already running,
+    or the configuration says the queue is served by an external worker (python ingest.py worker).
+
+    Each worker runs one job at a time, so the pool ingests into several collections at once.
+
+    Args:
+        analytiq_config (dict): The Analytiq configuration.
+    """
+    if analytiq_config.get("ingest_worker", "thread") != "thread":
+        return
+
+    with _ingest_workers_lock:
+        threads = [thread for thread in _ingest_workers.get(analytiq_config["docstore"], [])
+                   if thread.is_alive()]
+        for idx in range(len(threads), analytiq_config.get("ingest_workers", 1)):
+            thread = threading.Thread(target=run_ingest_worker,
+                                      args=(analytiq_config,),
+                                      name=f"ingest-worker-{idx}",
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+        _ingest_workers[analytiq_config["docstore"]] = threads
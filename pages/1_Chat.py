@@ -1,9 +1,6 @@
 import streamlit as st
 from langchain.chat_models import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.callbacks import get_openai_callback
-from langchain.chains import ConversationalRetrievalChain
+from langchain.memory import ConversationSummaryBufferMemory
 
 import utils
 from config_utils import (
@@ -12,7 +9,20 @@ from config_utils import (
     get_collections,
 )
 from chroma_utils import (
-    get_chroma_retriever
+    get_chroma_chunks
+)
+from retriever_utils import (
+    get_hybrid_retriever
+)
+from answer_cache_utils import (
+    get_answer_filter_key
+)
+from chat_utils import (
+    get_chat_service
+)
+from file_server_utils import (
+    start_file_server,
+    get_file_url
 )
 
 # Initialize the page
@@ -77,23 +87,10 @@ else:
     analytiq_fetch_k = 4
     analytiq_collection_name = "default"
 
-model_chunk_size = {
-    "gpt-3.5-turbo": 1500,
-    "gpt-3.5-turbo-16k": 6000, 
-    "gpt-4": 3000, 
-    "gpt-4-32k": 32000,
-}
-
-class StreamHandler(BaseCallbackHandler):
-    def __init__(self, container: st.delta_generator.DeltaGenerator, initial_text: str = ""):
-        self.container = container
-        self.text = initial_text
+# Serve the referenced files, so that the page only sends links to them
+start_file_server(analytiq_config)
 
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.text += token
-        self.container.markdown(self.text)
-
-def display_references(container, documents, response_idx):
+def display_references(container, documents):
     """
     Display the references in a streamlit container.
 
@@ -102,54 +99,54 @@ def display_references(container, documents, response_idx):
         documents (list): The list of documents.
     """
     expander = container.expander("References")
-    for idx, doc in enumerate(documents):
+    for doc in documents:
+        # Link to the file, which the browser fetches from the file server on click
         file_name = doc.metadata["file_name"]
-        id = doc.metadata["uuid"]
-        file_path = f"{analytiq_config['docstore']}/doc/{id}/{file_name}"
-        # Create download button
-        expander.download_button(label=file_name, data=open(file_path, "rb"), key=f"reference_{response_idx}_{idx}")
+        expander.markdown(f"[{file_name}]({get_file_url(analytiq_config, doc.metadata)})")
         # Write the chunk
         expander.markdown(doc.page_content)
 
-class PrintRetrievalHandler(BaseCallbackHandler):
-    def __init__(self, container, response_idx):
-        self._container = container
-        self._response_idx = response_idx
-
-    def on_retriever_start(self, serialized, query, **kwargs):
-        pass
-
-    def on_retriever_end(self, documents, **kwargs):
-        # Display the references
-        display_references(self._container, documents, self._response_idx)
-        # Save the documents
-        st.session_state.messages.append({"role": "references", "content": documents})
-
-retriever = get_chroma_retriever(
+retriever = get_hybrid_retriever(
     analytiq_config=analytiq_config,
+    analytiq_collections=analytiq_collections,
     collection_name=analytiq_collection_name,
     search_k=analytiq_search_k,
-    fetch_k=analytiq_fetch_k)
-
-# Setup memory for contextual conversation
-memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-
-# Setup LLM and QA chain
-llm = ChatOpenAI(
-    model_name=model, temperature=0, streaming=True
-)
-qa_chain = ConversationalRetrievalChain.from_llm(
-    llm, retriever=retriever, memory=memory, verbose=True
-)
+    fetch_k=analytiq_fetch_k,
+    doc_types=document_type,
+    doc_years=document_year)
+
+# Setup memory for contextual conversation, kept across reruns. Turns beyond the token
+# limit are folded into a running summary.
+if "chat_memory" not in st.session_state or clear_message_history_p:
+    st.session_state["chat_memory"] = ConversationSummaryBufferMemory(
+        llm=ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0),
+        max_token_limit=analytiq_config["chat_memory_tokens"],
+        memory_key="chat_history",
+        input_key="question",
+        output_key="answer",
+        return_messages=True)
+memory = st.session_state["chat_memory"]
 
 if "messages" not in st.session_state or clear_message_history_p:
     st.session_state["messages"] = [{"role": "assistant", "content": "How can I help you?"}]
 
+# Fetch the reference chunks of the whole history, with one Chroma call per collection
+reference_ids = {}
+for msg in st.session_state.messages:
+    if msg["role"] == "references":
+        reference_ids.setdefault(msg["collection_name"], set()).update(msg["content"])
+reference_chunks = {}
+for collection_name, chunk_ids in reference_ids.items():
+    for doc in get_chroma_chunks(analytiq_config=analytiq_config,
+                                 collection_name=collection_name,
+                                 chunk_ids=list(chunk_ids)):
+        reference_chunks[(collection_name, doc.metadata["chunk_id"])] = doc
+
 references = None
-response_idx = 0 # The index of the message
 for msg in st.session_state.messages:
     if msg["role"] == "references":
-        references = msg["content"]
+        references = [reference_chunks[(msg["collection_name"], chunk_id)] for chunk_id in msg["content"]
+                      if (msg["collection_name"], chunk_id) in reference_chunks]
     elif msg["role"] == "user":
         st.chat_message(msg["role"]).write(msg["content"])
         # Clear the references
@@ -157,9 +154,8 @@ for msg in st.session_state.messages:
     elif msg["role"] == "assistant":
         with st.chat_message(msg["role"]):
             if references is not None:
-                display_references(st.container(), references, response_idx)
+                display_references(st.container(), references)
             st.write(msg["content"])
-        response_idx += 1
     else:
         raise ValueError(f"Unknown role: {msg['role']}")
 
@@ -170,14 +166,42 @@ if user_query:
     st.chat_message("user").write(user_query)
 
     with st.chat_message("assistant"):
-        retrieval_handler = PrintRetrievalHandler(st.container(), response_idx)
-        stream_handler = StreamHandler(st.empty())
-
-        with get_openai_callback() as cost:
-            response = qa_chain.run(user_query, callbacks=[retrieval_handler, stream_handler])
-            print(cost)
-
-        st.session_state.messages.append({"role": "assistant", "content": response})
+        references_container = st.container()
+        answer_container = st.empty()
+
+        # The chat service condenses the question, serves it from the answer cache
+        # or retrieves the references and streams the answer
+        chat_history = memory.load_memory_variables({})["chat_history"]
+        events = get_chat_service(analytiq_config).ask(
+            session_id=utils.get_session_id(),
+            retriever=retriever,
+            collection_name=analytiq_collection_name,
+            filter_key=get_answer_filter_key(doc_types=document_type, doc_years=document_year),
+            model=model,
+            question=user_query,
+            chat_history=chat_history)
+
+        response = None
+        text = ""
+        for event in events:
+            if event["type"] == "references":
+                display_references(references_container, event["documents"])
+                # Save the chunk ids, rather than the documents
+                st.session_state.messages.append({"role": "references",
+                                                  "collection_name": analytiq_collection_name,
+                                                  "content": [doc.metadata["chunk_id"] for doc in event["documents"]]})
+            elif event["type"] == "token":
+                text += event["token"]
+                answer_container.markdown(text)
+            elif event["type"] == "answer":
+                response = event["answer"]
+                answer_container.markdown(response)
+            else:
+                st.error(event["error"])
+
+        if response is not None:
+            memory.save_context({"question": user_query}, {"answer": response})
+            st.session_state.messages.append({"role": "assistant", "content": response})
 
 # Set up the page footer
 utils.page_footer()
\ No newline at end of file
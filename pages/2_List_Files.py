@@ -8,11 +8,17 @@ from config_utils import (
     get_categories,
     get_collections,
     get_docs,
-    save_docs,
+    update_doc,
+    delete_doc,
 )
 from chroma_utils import (
-    check_chroma_file
+    check_chroma_files,
+    update_chroma_file_manifest
 ) 
+from file_server_utils import (
+    start_file_server,
+    get_file_url
+)
 
 # Initialize the page
 utils.page_init()
@@ -26,12 +32,12 @@ utils.page_header()
 
 # Get the ChromaDB configuration
 analytiq_config = get_analytiq_config()
+# Serve the docstore files, so that the page only sends links to them
+start_file_server(analytiq_config)
 # Get the categories
 analytiq_categories = get_categories(analytiq_config=analytiq_config)
 # Get the collections
 analytiq_collections = get_collections(analytiq_config=analytiq_config)
-# Get the docs
-analytiq_docs = get_docs(analytiq_config=analytiq_config)
 
 # Create multiple choice dropdown button
 document_type = st.sidebar.multiselect(
@@ -50,6 +56,17 @@ document_year = st.sidebar.multiselect(
 
 edit_files = st.sidebar.checkbox("Edit Files", value=False, key="edit_files")
 
+# The file manifests as they were when their edit widgets were created, by uuid. The widgets
+# keep this session's edits across reruns, so the saves are checked against these.
+if not edit_files:
+    st.session_state["edit_docs_orig"] = {}
+edit_docs_orig = st.session_state.setdefault("edit_docs_orig", {})
+
+# Get the docs of the selected types and years
+analytiq_docs = get_docs(analytiq_config=analytiq_config,
+                         doc_types=document_type,
+                         doc_years=document_year)
+
 def display_files():
     """
     Display the files tab
@@ -74,28 +91,32 @@ def display_files():
         with collection_col:
             st.text("Collection")
 
-    for file_manifest in analytiq_docs:
-        if len(document_year) > 0 and file_manifest["year"] not in document_year:
-            continue
-        if len(document_type) > 0 and file_manifest["type"] not in document_type:
-            continue
+    file_manifests = analytiq_docs
+
+    if not edit_files:
+        # Look up the collections of all displayed files at once
+        file_collections = check_chroma_files(analytiq_config=analytiq_config,
+                                              analytiq_collections=analytiq_collections,
+                                              file_manifests=file_manifests)
 
+    for file_manifest in file_manifests:
         if edit_files:
             file_col, type_col, year_col, delete_col = st.columns([3, 3, 1, 1])
         else:
             file_col, type_col, year_col, collection_col = st.columns([3, 3, 1, 1])
 
+        # Remember the manifest when the edit widgets are created, to save it only if it changes
+        type_key = f"type_{file_manifest['file_name']}"
+        year_key = f"year_{file_manifest['file_name']}"
+        if type_key not in st.session_state or file_manifest["uuid"] not in edit_docs_orig:
+            edit_docs_orig[file_manifest["uuid"]] = dict(file_manifest)
+        file_manifest_orig = edit_docs_orig[file_manifest["uuid"]]
+
         # Display two dropdown menus for each file
         with file_col:
-            # Create a download link to the file on disk
+            # Create a link to the file, served by the file server
             file_name = file_manifest["file_name"]
-            uuid = file_manifest["uuid"]
-            full_file_name = f"{analytiq_config['docstore']}/doc/{uuid}/{file_name}"
-            with open(full_file_name, "rb") as file:
-                st.download_button(label=file_name, 
-                                file_name=file_name,
-                                mime="application/pdf",
-                                data=file)
+            st.markdown(f"[{file_name}]({get_file_url(analytiq_config, file_manifest)})")
 
         with type_col:
             if edit_files:                
@@ -105,7 +126,7 @@ def display_files():
                     "Type:",
                     analytiq_categories["type"], 
                     index = type_index,
-                    key=f"type_{file_manifest['file_name']}",
+                    key=type_key,
                     label_visibility="collapsed"
                     )
             else:
@@ -118,11 +139,27 @@ def display_files():
                 file_manifest["year"] = st.selectbox("Year:", 
                                                 ["2023", "2022", "2021", "2020", "2019", "2018", "2017", "2016", "2015"],
                                                 index=year_index,
-                                                key=f"year_{file_manifest['file_name']}",
+                                                key=year_key,
                                                 label_visibility="collapsed")
             else:
                 st.write(file_manifest["year"])
         
+        if edit_files and file_manifest != file_manifest_orig:
+            # Save the file manifest, unless another session changed it since the widgets were created
+            if update_doc(analytiq_config=analytiq_config, 
+                          file_manifest=file_manifest,
+                          file_manifest_orig=file_manifest_orig):
+                # Update the type and year of the file chunks, which the Chat filters search
+                update_chroma_file_manifest(analytiq_config=analytiq_config,
+                                            file_manifest=file_manifest,
+                                            file_manifest_orig=file_manifest_orig)
+                edit_docs_orig[file_manifest["uuid"]] = dict(file_manifest)
+            else:
+                # Show the other session's changes on the next run
+                del st.session_state[type_key]
+                del st.session_state[year_key]
+                del edit_docs_orig[file_manifest["uuid"]]
+
         if edit_files:
             with delete_col:
                 if st.button("Delete", key=f"delete_{file_manifest['file_name']}"):
@@ -134,18 +171,10 @@ def display_files():
                     st.info(f"Deleted {full_file_name}")
 
                     # Delete the file manifest
-                    analytiq_docs.remove(file_manifest)
-
-                    # Save the docs
-                    save_docs(analytiq_config=analytiq_config, docs=analytiq_docs)
+                    delete_doc(analytiq_config=analytiq_config, file_uuid=file_manifest["uuid"])
         else:
             with collection_col:
-                names = []
-                for collection_name in analytiq_collections:
-                    if check_chroma_file(analytiq_config=analytiq_config, 
-                                         collection_name=collection_name,
-                                         file_manifest=file_manifest):
-                        names.append(collection_name)
+                names = file_collections[file_manifest["uuid"]]
                 st.write(", ".join(names))
 
 display_files()
@@ -1,36 +1,32 @@
-import os
-import json
-import streamlit as st
-
-
-from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
-from langchain.vectorstores import Chroma
+import time
 import uuid
-
-from tqdm import tqdm
-from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.document_loaders import DirectoryLoader
-from langchain.document_loaders import UnstructuredPDFLoader
+import streamlit as st
 
 import utils
 from config_utils import (
     get_analytiq_config,
     get_categories,
     get_collections,
-    get_docs,
-    save_docs,
-)
-from collection_utils import (
-    get_collection_loader,
-    get_collection_splitter
+    get_doc_by_name,
+    get_doc_by_hash,
+    add_doc,
+    update_doc,
+    stage_upload,
+    commit_upload,
+    discard_upload,
 )
 from chroma_utils import (
     get_chroma_client,
-    get_chroma_collection,
-    check_chroma_file,
-    add_chroma_file_chunks,
-    delete_chroma_file_chunks
+    check_chroma_files,
+    delete_chroma_file_chunks,
+    update_chroma_file_manifest
+)
+from ingest_utils import (
+    check_ingest_job_lease,
+    enqueue_ingest_job,
+    get_ingest_job,
+    get_file_ingest_jobs,
+    start_ingest_worker
 )
 
 # Initialize the page
@@ -49,10 +45,10 @@ analytiq_config = get_analytiq_config()
 analytiq_categories = get_categories(analytiq_config=analytiq_config)
 # Get the collections
 analytiq_collections = get_collections(analytiq_config=analytiq_config)
-# Get the docs
-analytiq_docs = get_docs(analytiq_config=analytiq_config)
 # Create the chroma client and save it in the session state
 get_chroma_client(analytiq_config=analytiq_config, analytiq_collections=analytiq_collections)
+# Make sure uploads get ingested in the background
+start_ingest_worker(analytiq_config=analytiq_config)
 
 # Checkbox for advanced options
 advanced_options = st.sidebar.checkbox("Advanced Options", value=False, key="advanced_options")
@@ -67,8 +63,11 @@ if advanced_options:
 else:
     analytiq_collection_name = "default"
 
-def display_upload_files():
+def display_upload_files() -> bool:
     """Display the upload tab
+
+    Returns:
+        bool: True if the uploads started from the tab are still running.
     """
 
     st.write("Upload file. Select the type and year. Select one or more collections.")
@@ -93,15 +92,35 @@ def display_upload_files():
         if uploaded_file is not None:
             # Check if the file is in the docs
             file_name = uploaded_file.name
-            for f_manifest in analytiq_docs:
-                if f_manifest["file_name"] == file_name:
-                    file_manifest = f_manifest
-                    file_path = f"{analytiq_config['docstore']}/doc/{file_manifest['uuid']}/{file_name}"
-                    break
+            file_manifest = get_doc_by_name(analytiq_config=analytiq_config, file_name=file_name)
+
+            if file_manifest is None:
+                # Stage the upload once, hashing it while it is written
+                upload_key = f"{file_name}_{uploaded_file.size}"
+                staged_upload = st.session_state.get("staged_upload")
+                if staged_upload is None or staged_upload["key"] != upload_key:
+                    if staged_upload is not None:
+                        discard_upload(staged_upload["path"])
+                    staged_path, sha256 = stage_upload(analytiq_config=analytiq_config, stream=uploaded_file)
+                    staged_upload = {"key": upload_key, "path": staged_path, "sha256": sha256}
+                    st.session_state.staged_upload = staged_upload
+
+                # Is the same file already in the docs, under another name?
+                file_manifest = get_doc_by_hash(analytiq_config=analytiq_config, sha256=staged_upload["sha256"])
+                if file_manifest is not None:
+                    discard_upload(staged_upload["path"])
+                    st.info(f"{file_name} has the same contents as {file_manifest['file_name']}, which is already uploaded")
+                    file_name = file_manifest["file_name"]
+
+            if file_manifest is not None:
+                file_path = f"{analytiq_config['docstore']}/doc/{file_manifest['uuid']}/{file_name}"
             
             if "upload_file" not in st.session_state:
                 st.session_state.upload_file = file_name
         else:
+            if "staged_upload" in st.session_state:
+                discard_upload(st.session_state.staged_upload["path"])
+                del st.session_state.staged_upload
             if "upload_file" in st.session_state:
                 del st.session_state.upload_file
             if "selected_type" in st.session_state:
@@ -153,6 +172,12 @@ def display_upload_files():
             st.session_state.file_in_collection = {}
 
         st.text("Collections:")
+        file_collections = {}
+        if file_manifest is not None:
+            # Look up all the collections of the file at once
+            file_collections = check_chroma_files(analytiq_config=analytiq_config,
+                                                  analytiq_collections=analytiq_collections,
+                                                  file_manifests=[file_manifest])
         for collection_name in analytiq_collections:
             checkbox_disabled=True
             st.session_state.file_in_collection[collection_name] = False
@@ -162,9 +187,7 @@ def display_upload_files():
                 checkbox_disabled=False
 
                 # Check if the file is in the collection
-                file_in_collection = check_chroma_file(analytiq_config=analytiq_config,
-                                                       collection_name=collection_name,
-                                                       file_manifest=file_manifest)
+                file_in_collection = collection_name in file_collections[file_manifest["uuid"]]
                 st.session_state.file_in_collection[collection_name] = file_in_collection
 
             checkbox_key = f"checkbox_{collection_name}"
@@ -182,78 +205,89 @@ def display_upload_files():
                                    key=checkbox_key)
 
     if uploaded_file is not None:
-        bytes_data = uploaded_file.getvalue()
-
         if selected_type == "" or selected_year == "":
             st.error("Please select a type and a year.")
         elif file_manifest:
             if selected_type != file_manifest["type"] or selected_year != file_manifest["year"]:
-                # Update the file manifest. It is a reference to the analytiq_docs, so 
-                # analytiq_docs will be updated as well.
+                # Update the file manifest
+                file_manifest_orig = dict(file_manifest)
                 file_manifest["type"] = selected_type
                 file_manifest["year"] = selected_year
 
-                # Save the docs
-                save_docs(analytiq_config=analytiq_config, docs=analytiq_docs)
+                # Save the file manifest, unless another session changed it, and update its chunks
+                if update_doc(analytiq_config=analytiq_config, 
+                              file_manifest=file_manifest,
+                              file_manifest_orig=file_manifest_orig):
+                    update_chroma_file_manifest(analytiq_config=analytiq_config,
+                                                file_manifest=file_manifest,
+                                                file_manifest_orig=file_manifest_orig)
         else:
             # Create a uuid for the file
             id = str(uuid.uuid4())
-            # Create the uuid folder
-            os.makedirs(f"{analytiq_config['docstore']}/doc/{id}", exist_ok=True)
-            # Save the file to the uuid folder
-            file_path = f"{analytiq_config['docstore']}/doc/{id}/{file_name}"
-            with open(file_path, "wb") as f:
-                f.write(bytes_data)
-                st.info(f"Saved {file_path}")
             
             # Create a file manifest
             file_manifest = {
                 "file_name": file_name,
                 "type": selected_type,
                 "year": selected_year,
-                "uuid": id
+                "uuid": id,
+                "sha256": st.session_state.staged_upload["sha256"]
             }
 
+            # Move the staged file to the uuid folder
+            file_path = commit_upload(analytiq_config=analytiq_config,
+                                      staged_path=st.session_state.staged_upload["path"],
+                                      file_manifest=file_manifest)
+            del st.session_state.staged_upload
+            st.info(f"Saved {file_path}")
+
             # Add the file manifest to the docs
-            analytiq_docs.append(file_manifest)
+            add_doc(analytiq_config=analytiq_config, file_manifest=file_manifest)
 
-            # Save the docs
-            save_docs(analytiq_config=analytiq_config, docs=analytiq_docs)
+        if file_manifest is None:
+            # Nothing to upload until the type and year are selected
+            return False
+
+        # Get the most recent ingestion job of the file, by collection
+        latest_jobs = {}
+        for job in get_file_ingest_jobs(analytiq_config=analytiq_config, file_uuid=file_manifest["uuid"]):
+            latest_jobs.setdefault(job["collection_name"], job)
+
+        # The ingestion jobs started from this session
+        if "upload_jobs" not in st.session_state:
+            st.session_state.upload_jobs = {}
 
         # Upload the file to the collections
+        pending_jobs = {}
         for collection_name in analytiq_collections:
-            collection = analytiq_collections[collection_name]
             checkbox_key = f"checkbox_{collection_name}"
             checkbox = st.session_state[checkbox_key]
+            upload_job_key = f"{file_manifest['uuid']}_{collection_name}"
+            job = latest_jobs.get(collection_name)
+            # A running job whose lease expired is queued again by the next worker to claim a job
+            job_pending = (job is not None and (job["status"] == "queued" or check_ingest_job_lease(job))
+                           and job["state"] not in ["uploaded", "failed"])
+
             if not st.session_state.file_in_collection[collection_name] and checkbox:
-                # Will upload the file to this collection
-                with st.status(f"Parsing {file_name}..."):
-                    # Create the pdf loader
-                    loader = get_collection_loader(analytiq_config=analytiq_config,
-                                                   collection=collection,
-                                                   file_path=file_path)
-                    docs = loader.load()
-
-                # Split it into chunks
-                with st.status(f"Splitting {file_name}..."):
-                    splitter = get_collection_splitter(analytiq_config=analytiq_config,
-                                                       collection=collection)
-                    split_docs = splitter.split_documents(docs)
-                
-                print(f"Split {file_name} into {len(split_docs)} chunks")
-
-                with st.status(f"Uploading {file_name} chunks..."):
-                    metadatas = [file_manifest for _ in split_docs]
-                    file_chunks = [doc.page_content for doc in split_docs]
-                    add_chroma_file_chunks(analytiq_config=analytiq_config,
-                                           collection_name=collection_name,
-                                           metadatas=metadatas,
-                                           file_chunks=file_chunks)
-
-                    print(f"Uploaded {file_name} chunks to {collection_name}")
-                    # Update the state
-                    st.session_state.file_in_collection[collection_name] = True
-            
+                if job_pending:
+                    # The file is on its way to the collection
+                    st.session_state.upload_jobs[upload_job_key] = job["job_id"]
+                    pending_jobs[collection_name] = job
+                elif upload_job_key not in st.session_state.upload_jobs:
+                    # Hand the file to the ingestion worker
+                    job_id = enqueue_ingest_job(analytiq_config=analytiq_config,
+                                                collection_name=collection_name,
+                                                file_manifests=[file_manifest])
+                    st.session_state.upload_jobs[upload_job_key] = job_id
+                    pending_jobs[collection_name] = {"job_id": job_id, "status": "queued", "state": "pending"}
+                    print(f"Queued {file_name} for upload to {collection_name}")
+                elif job is not None and job["state"] == "failed":
+                    st.error(f"Failed to upload {file_name} to {collection_name}: {job['error']}")
+
+            if not checkbox:
+                # Checking the collection again will start a new upload
+                st.session_state.upload_jobs.pop(upload_job_key, None)
+
             if st.session_state.file_in_collection[collection_name] and not checkbox:
                 # Will remove this file from this collection
                 delete_chroma_file_chunks(analytiq_config=analytiq_config,
@@ -265,10 +299,130 @@ def display_upload_files():
                 # Update the state
                 st.session_state.file_in_collection[collection_name] = False
 
+        # Show the progress of the uploads
+        for collection_name, job in pending_jobs.items():
+            st.info(f"Uploading {file_name} to {collection_name}: {job['state']}")
+
+        print(f"st.session_state   end: {st.session_state}")
+        return len(pending_jobs) > 0
+
     print(f"st.session_state   end: {st.session_state}")
+    return False
 
+def register_upload(uploaded_file, file_type: str, file_year: str) -> dict:
+    """
+    Add an uploaded file to the docs, unless a file with the same name or contents is already there.
+
+    Args:
+        uploaded_file (UploadedFile): The uploaded file.
+        file_type (str): The type of the file.
+        file_year (str): The year of the file.
 
-display_upload_files()
+    Returns:
+        dict: The file manifest of the new or existing file.
+    """
+    file_name = uploaded_file.name
+    file_manifest = get_doc_by_name(analytiq_config=analytiq_config, file_name=file_name)
+    if file_manifest is not None:
+        st.info(f"{file_name} is already uploaded")
+        return file_manifest
+
+    staged_path, sha256 = stage_upload(analytiq_config=analytiq_config, stream=uploaded_file)
+    file_manifest = get_doc_by_hash(analytiq_config=analytiq_config, sha256=sha256)
+    if file_manifest is not None:
+        discard_upload(staged_path)
+        st.info(f"{file_name} has the same contents as {file_manifest['file_name']}, which is already uploaded")
+        return file_manifest
+
+    file_manifest = {
+        "file_name": file_name,
+        "type": file_type,
+        "year": file_year,
+        "uuid": str(uuid.uuid4()),
+        "sha256": sha256
+    }
+    commit_upload(analytiq_config=analytiq_config, staged_path=staged_path, file_manifest=file_manifest)
+    add_doc(analytiq_config=analytiq_config, file_manifest=file_manifest)
+    return file_manifest
+
+def display_batch_upload() -> bool:
+    """Display the batch upload tab
+
+    Returns:
+        bool: True if the uploads started from the tab are still running.
+    """
+
+    st.write("Upload files of the same type and year. Select the collections to add them to. "
+             "The files are added to the collections in the background.")
+
+    uploaded_files = st.file_uploader("Upload Files", accept_multiple_files=True, type=["pdf"], key="batch_files")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        batch_type = st.selectbox(label="Type:", options=[""] + analytiq_categories["type"], key="batch_type")
+        batch_year = st.selectbox(label="Year:", options=[""] + analytiq_categories["year"], key="batch_year")
+    with col2:
+        batch_collections = st.multiselect(label="Collections:",
+                                           options=list(analytiq_collections.keys()),
+                                           default=[analytiq_collection_name],
+                                           key="batch_collections")
+
+    # The batch ingestion jobs started from this session
+    if "batch_jobs" not in st.session_state:
+        st.session_state.batch_jobs = []
+
+    upload = st.button("Upload", key="batch_upload", disabled=len(uploaded_files) == 0)
+    if upload:
+        if batch_type == "" or batch_year == "":
+            st.error("Please select a type and a year.")
+        else:
+            # Register each file right away
+            file_manifests = {}
+            for uploaded_file in uploaded_files:
+                file_manifest = register_upload(uploaded_file, batch_type, batch_year)
+                file_manifests[file_manifest["uuid"]] = file_manifest
+
+            # Hand the files missing from each collection to the ingestion workers
+            file_collections = check_chroma_files(analytiq_config=analytiq_config,
+                                                  analytiq_collections=analytiq_collections,
+                                                  file_manifests=list(file_manifests.values()))
+            for collection_name in batch_collections:
+                collection_manifests = [file_manifest for file_manifest in file_manifests.values()
+                                        if collection_name not in file_collections[file_manifest["uuid"]]]
+                if len(collection_manifests) == 0:
+                    continue
+                job_id = enqueue_ingest_job(analytiq_config=analytiq_config,
+                                            collection_name=collection_name,
+                                            file_manifests=collection_manifests)
+                st.session_state.batch_jobs.append(job_id)
+
+    # Show the progress of each file
+    jobs_pending = False
+    for job_id in st.session_state.batch_jobs:
+        job = get_ingest_job(analytiq_config=analytiq_config, job_id=job_id)
+        if job is None:
+            continue
+        n_files = len(job["files"])
+        n_done = len([job_file for job_file in job["files"] if job_file["state"] in ["uploaded", "failed"]])
+        jobs_pending = jobs_pending or ((job["status"] == "queued" or check_ingest_job_lease(job)) and n_done < n_files)
+
+        st.progress(n_done / max(n_files, 1), text=f"{job['collection_name']}: {n_done} of {n_files} files ({job['status']})")
+        st.dataframe([{"File": job_file["file_name"], "State": job_file["state"], "Error": job_file["error"] or ""}
+                      for job_file in job["files"]],
+                     use_container_width=True)
+
+    return jobs_pending
+
+upload_file_tab, upload_files_tab = st.tabs(["Upload File", "Upload Files"])
+with upload_file_tab:
+    upload_file_pending = display_upload_files()
+with upload_files_tab:
+    upload_files_pending = display_batch_upload()
+
+# Poll until the uploads are done
+if upload_file_pending or upload_files_pending:
+    time.sleep(2)
+    st.rerun()
 
 # Set up the page footer
 utils.page_footer()
\ No newline at end of file
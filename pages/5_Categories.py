@@ -19,10 +19,8 @@ import utils
 from config_utils import (
     get_analytiq_config,
     get_categories,
-    get_docs,
-    save_categories,
-    save_docs,
-    normalize_chroma_schema
+    count_docs,
+    save_categories
 )
 
 # Initialize the page
@@ -39,8 +37,6 @@ utils.page_header()
 analytiq_config = get_analytiq_config()
 # Get the categories
 analytiq_categories = get_categories(analytiq_config=analytiq_config)
-# Get the docs
-analytiq_docs = get_docs(analytiq_config=analytiq_config)
                 
 def display_categories():
     """
@@ -74,11 +70,9 @@ def display_categories():
                     for value in selected_values_to_remove:
                         if value in analytiq_categories[category]:
                             # Ensure no files have this category
-                            nfiles = 0
-                            for file_manifest in analytiq_docs:
-                                if file_manifest[category] == value:
-                                    st.error(f"Cannot remove {category} {value} because file {file_manifest['file_name']} has this {category}.")
-                                    nfiles += 1
+                            nfiles = count_docs(analytiq_config=analytiq_config, category=category, value=value)
+                            if nfiles > 0:
+                                st.error(f"Cannot remove {category} {value} because {nfiles} files have this {category}.")
 
                             if nfiles == 0:
                                 analytiq_categories[category].remove(value)
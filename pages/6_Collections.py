@@ -1,5 +1,4 @@
 import streamlit as st
-from tqdm import tqdm
 
 from langchain.text_splitter import Language
 
@@ -11,17 +10,23 @@ from config_utils import (
     get_docs,
     save_collections,
 )
-from collection_utils import (
-    get_collection_loader,
-    get_collection_splitter
-)
 from chroma_utils import (
     get_chroma_collection,
     delete_chroma_collection,
-    check_chroma_file,
+    check_chroma_files,
     list_chroma_collection,
-    clear_chroma_collection,
-    add_chroma_file_chunks
+    clear_chroma_collection
+)
+from collection_utils import (
+    get_collection_fingerprint
+)
+from ingest_utils import (
+    check_ingest_job_lease,
+    create_ingest_job,
+    list_ingest_jobs,
+    run_ingest_job,
+    schedule_collection_reingest,
+    start_ingest_worker
 )
 
 # Initialize the page
@@ -43,6 +48,69 @@ analytiq_collections = get_collections(analytiq_config=analytiq_config)
 # Get the docs
 analytiq_docs = get_docs(analytiq_config=analytiq_config)
 
+# The settings widgets of each collection, by setting, and the prefixes of their keys
+collection_widget_keys = {
+    "parser": "parser",
+    "length_function": "length-function",
+    "splitter": "splitter",
+    "chunk_size": "chunk-size",
+    "chunk_overlap": "chunk-overlap",
+    "embedding": "embedding",
+}
+
+# The settings widgets keep this session's edits across reruns, over the collections read at
+# collections_edit_version. If another session saved the collections since, drop the widget
+# values, so that they are not saved over the other session's changes.
+if st.session_state.get("collections_edit_version") != st.session_state["collections_version"]:
+    collections_edit_orig = st.session_state.get("collections_edit_orig", {})
+    edited = False
+    for collection_name, collection in collections_edit_orig.items():
+        for setting, key_prefix in collection_widget_keys.items():
+            key = f"{key_prefix}-{collection_name}"
+            if key in st.session_state:
+                edited = edited or st.session_state[key] != collection[setting]
+                del st.session_state[key]
+    if edited:
+        st.warning("The collections were changed by another session. Your last change was not saved, make it again.")
+    st.session_state["collections_edit_version"] = st.session_state["collections_version"]
+    st.session_state["collections_edit_orig"] = st.session_state["collections_orig"]
+
+# The fingerprints of the saved collection settings, to detect the changes made on this page
+saved_fingerprints = {collection_name: get_collection_fingerprint(collection)
+                      for collection_name, collection in analytiq_collections.items()}
+
+# Start the ingestion workers, which reingest the collections whose settings change
+start_ingest_worker(analytiq_config=analytiq_config)
+
+def run_job(collection_name: str, job_id: str, n_files: int, retry_failed: bool = False):
+    """
+    Run an ingestion job, displaying its progress
+    """
+    progress_bar = st.progress(0, text=f"Uploading files to {collection_name}")
+    n_done = 0
+
+    def progress_callback(file_manifest, n_chunks, error):
+        nonlocal n_done
+        n_done += 1
+        file_name = file_manifest["file_name"]
+        if error is not None:
+            st.error(f"Failed to upload {file_name}: {error}")
+        progress_bar.progress(min(1.0, n_done / n_files),
+                              text=f"Uploaded {file_name} ({n_chunks} chunks), {n_done}/{n_files} files")
+
+    # Parse, split, embed and upload the files in parallel
+    result = run_ingest_job(analytiq_config=analytiq_config,
+                            analytiq_collections=analytiq_collections,
+                            analytiq_docs=analytiq_docs,
+                            job_id=job_id,
+                            retry_failed=retry_failed,
+                            progress_callback=progress_callback)
+
+    if len(result["failed"]) > 0:
+        st.warning(f"Uploaded {len(result['uploaded'])} files to {collection_name}, {len(result['failed'])} failed")
+    else:
+        st.success(f"Uploaded all files to {collection_name}")
+
 def display_collections():
     """
     Display the collections
@@ -212,46 +280,41 @@ def display_collections():
             delete_all_files = st.button("Delete all files", key=delete_all_files_key)
 
             if upload_all_files:
-                # Get the splitter
-                splitter = get_collection_splitter(analytiq_config=analytiq_config,
-                                                   collection=collection)
-
-                # Loop over the files
-                for file_manifest in tqdm(analytiq_docs, desc=f"Uploading files to {collection_name}"):
-                    # Check if the file is already in the collection
-                    if check_chroma_file(analytiq_config=analytiq_config, 
-                                         collection_name=collection_name, 
-                                         file_manifest=file_manifest):
-                        continue
-
-                    # Get the file path
-                    file_name = file_manifest["file_name"]
-                    id = file_manifest["uuid"]
-                    file_path = f"{analytiq_config['docstore']}/doc/{id}/{file_name}"
-
-                    # Get the loader
-                    loader = get_collection_loader(analytiq_config=analytiq_config,
-                                                    collection=collection,
-                                                    file_path=file_path)
-
-                    # Get the text
-                    with st.status(f"Parsing {file_name}..."):
-                        docs = loader.load()
-
-                    # Split the text into chunks
-                    with st.status(f"Splitting {file_name}..."):
-                        split_docs = splitter.split_documents(docs)
-
-                    # Add the chunks to the collection
-                    with st.status(f"Uploading {file_name} chunks..."):
-                        metadatas = [file_manifest for _ in split_docs]
-                        file_chunks = [doc.page_content for doc in split_docs]
-                        add_chroma_file_chunks(analytiq_config=analytiq_config,
-                                               collection_name=collection_name,
-                                               metadatas=metadatas,
-                                               file_chunks=file_chunks)
-
-                st.success(f"Uploaded all files to {collection_name}")
+                # Skip the files already in the collection
+                file_collections = check_chroma_files(analytiq_config=analytiq_config,
+                                                      analytiq_collections={collection_name: collection},
+                                                      file_manifests=analytiq_docs)
+                file_manifests = [file_manifest for file_manifest in analytiq_docs
+                                  if collection_name not in file_collections[file_manifest["uuid"]]]
+
+                # Record the job in the journal, so that it can be resumed if interrupted
+                job_id = create_ingest_job(analytiq_config, collection_name, file_manifests)
+                run_job(collection_name=collection_name,
+                        job_id=job_id,
+                        n_files=len(file_manifests))
+
+            # Offer to resume the unfinished jobs
+            for job in list_ingest_jobs(analytiq_config, collection_name=collection_name):
+                if job["status"] in ["done", "superseded"]:
+                    continue
+                counts = job["counts"]
+                n_unfinished = sum(count for state, count in counts.items() 
+                                   if state not in ["uploaded", "failed"])
+                job_kind = job["stage"] if job["stage"] else "upload"
+                st.text(f"Job {job['job_id'][:8]} ({job_kind}) {job['status']}: {counts['uploaded']} uploaded, "
+                        f"{n_unfinished} unfinished, {counts['failed']} failed")
+                if job["status"] == "queued" or check_ingest_job_lease(job):
+                    # An ingestion worker will run it, or is running it
+                    continue
+                if n_unfinished > 0 and st.button("Resume", key=f"resume_{job['job_id']}"):
+                    run_job(collection_name=collection_name,
+                            job_id=job["job_id"],
+                            n_files=n_unfinished)
+                if counts["failed"] > 0 and st.button("Retry failed files", key=f"retry_{job['job_id']}"):
+                    run_job(collection_name=collection_name,
+                            job_id=job["job_id"],
+                            n_files=counts["failed"],
+                            retry_failed=True)
 
             if list_all_files:
                 fname_set = list_chroma_collection(analytiq_config=analytiq_config, 
@@ -271,7 +334,25 @@ def display_collections():
 
 
     # Save the collections if they have changed. This routine checks internally if the collections have changed.
-    save_collections(analytiq_config=analytiq_config, collections=analytiq_collections)
+    saved = save_collections(analytiq_config=analytiq_config, collections=analytiq_collections)
+    # The widgets now hold the saved collections
+    st.session_state["collections_edit_version"] = st.session_state["collections_version"]
+    st.session_state["collections_edit_orig"] = st.session_state["collections_orig"]
+    if saved:
+        # Reingest the collections whose settings changed, rerunning only the stages they affect
+        for collection_name, collection in analytiq_collections.items():
+            if collection_name not in saved_fingerprints:
+                continue
+            if get_collection_fingerprint(collection) == saved_fingerprints[collection_name]:
+                continue
+            plan = schedule_collection_reingest(analytiq_config=analytiq_config,
+                                                collection_name=collection_name,
+                                                collection=collection,
+                                                analytiq_docs=analytiq_docs)
+            if len(plan) > 0:
+                stages = {stage: list(plan.values()).count(stage) for stage in set(plan.values())}
+                st.info(f"Settings of {collection_name} changed. Queued "
+                        + ", ".join(f"{stage} of {count} files" for stage, count in stages.items()))
 
 display_collections()
 
@@ -19,11 +19,19 @@ import utils
 from config_utils import (
     get_analytiq_config,
     get_categories,
+    get_collections,
     get_docs,
     save_categories,
     save_docs,
     normalize_chroma_schema
 )
+from chroma_utils import (
+    get_chroma_collection,
+    reconcile_chroma_membership
+)
+from bm25_utils import (
+    rebuild_bm25_index
+)
 
 # Initialize the page
 utils.page_init()
@@ -52,5 +60,23 @@ if normalize_schema:
     analytiq_categories = get_categories(analytiq_config=analytiq_config)
     analytiq_docs = get_docs(analytiq_config=analytiq_config)
 
+# Create button to rebuild the collection membership index from ChromaDB
+reconcile_membership = st.button("Reconcile Collection Membership")
+if reconcile_membership:
+    membership = reconcile_chroma_membership(analytiq_config=analytiq_config)
+    for collection_name, uuids in membership.items():
+        st.info(f"Collection {collection_name} has {len(uuids)} files")
+
+# Create button to rebuild the keyword indexes from ChromaDB
+rebuild_keyword_index = st.button("Rebuild Keyword Index")
+if rebuild_keyword_index:
+    analytiq_collections = get_collections(analytiq_config=analytiq_config)
+    for collection_name in analytiq_collections:
+        chroma_collection = get_chroma_collection(analytiq_config=analytiq_config,
+                                                  analytiq_collections=analytiq_collections,
+                                                  collection_name=collection_name)
+        n_chunks = rebuild_bm25_index(analytiq_config, collection_name, chroma_collection)
+        st.info(f"Indexed {n_chunks} chunks of collection {collection_name}")
+
 # Set up the page footer
 utils.page_footer()
\ No newline at end of file
@@ -0,0 +1,66 @@
+import time
+import threading
+from sentence_transformers import CrossEncoder
+
+# Process-wide cross-encoder models, loaded once per model name
+_rerank_models = {}
+_rerank_locks = {}
+_rerank_models_lock = threading.Lock()
+
+def get_rerank_model(model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2") -> CrossEncoder:
+    """
+    Get the shared cross-encoder model, loading it on CPU on first use.
+
+    Args:
+        model_name (str, optional): The name of the cross-encoder model. Defaults to "cross-encoder/ms-marco-MiniLM-L-6-v2".
+
+    Returns:
+        CrossEncoder: The cross-encoder model.
+    """
+    with _rerank_models_lock:
+        if model_name not in _rerank_models:
+            _rerank_models[model_name] = CrossEncoder(model_name, device="cpu")
+            _rerank_locks[model_name] = threading.Lock()
+
+        return _rerank_models[model_name]
+
+def rerank_documents(query: str,
+                     documents: list,
+                     model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+                     top_n: int = 4,
+                     budget_ms: int = 500,
+                     batch_size: int = 16) -> list:
+    """
+    Rerank retrieved chunks by cross-encoder relevance to the query, within a latency budget.
+
+    The chunks are scored in batches, in their retrieval order. When the budget runs out,
+    the chunks not yet scored follow the scored ones in their retrieval order.
+
+    Args:
+        query (str): The query text.
+        documents (list): The langchain Documents, best retrieved first.
+        model_name (str, optional): The name of the cross-encoder model. Defaults to "cross-encoder/ms-marco-MiniLM-L-6-v2".
+        top_n (int, optional): The number of chunks to keep. Defaults to 4.
+        budget_ms (int, optional): The scoring time budget in milliseconds. Defaults to 500.
+        batch_size (int, optional): The number of chunks per model batch. Defaults to 16.
+
+    Returns:
+        list: The top_n Documents, most relevant first.
+    """
+    model = get_rerank_model(model_name)
+
+    # The budget covers scoring, not the one-time model load
+    deadline = time.monotonic() + budget_ms / 1000
+    scores = []
+    with _rerank_locks[model_name]:
+        for i in range(0, len(documents), batch_size):
+            if i > 0 and time.monotonic() >= deadline:
+                break
+            batch = documents[i:i + batch_size]
+            scores.extend(model.predict([(query, doc.page_content) for doc in batch],
+                                        batch_size=batch_size,
+                                        show_progress_bar=False))
+
+    scored = sorted(range(len(scores)), key=lambda idx: scores[idx], reverse=True)
+    ranked = [documents[idx] for idx in scored] + documents[len(scores):]
+    return ranked[:top_n]
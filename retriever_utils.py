@@ -0,0 +1,200 @@
+import asyncio
+from typing import List, Optional
+from langchain.schema import BaseRetriever, Document
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+
+from chroma_utils import (
+    get_chroma_chunks,
+    get_chroma_collection,
+    search_chroma_chunks
+)
+from bm25_utils import (
+    check_bm25_index,
+    rebuild_bm25_index,
+    search_bm25
+)
+from rerank_utils import (
+    rerank_documents
+)
+from chat_utils import (
+    pack_context
+)
+
+def reciprocal_rank_fusion(rankings: list, rrf_k: int = 60) -> list:
+    """
+    Fuse several rankings with reciprocal-rank fusion.
+
+    Args:
+        rankings (list): Lists of keys, best first.
+        rrf_k (int, optional): The rank offset, which damps the weight of the top ranks. Defaults to 60.
+
+    Returns:
+        list: The keys of all rankings, best fused score first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+class AnalytiqHybridRetriever(BaseRetriever):
+    """
+    Retriever fusing the Chroma vector search with a BM25 keyword search of the same collection.
+
+    The retriever holds no model or client of its own, so it is cheap to create on every rerun.
+    """
+    analytiq_config: dict
+    collection_name: str
+    embedding: str = "all-MiniLM-L6-v2"
+    k: int = 4
+    fetch_k: int = 4
+    bm25_k: int = 10
+    rrf_k: int = 60
+    doc_types: list = []
+    doc_years: list = []
+    # Optional cross-encoder reranking of the n_candidates best fused chunks down to k
+    rerank_model: str = ""
+    n_candidates: int = 4
+    rerank_budget_ms: int = 500
+    rerank_batch_size: int = 16
+    # Token budget of the returned chunks, None for no limit
+    max_tokens: Optional[int] = None
+
+    def _get_relevant_documents(self,
+                                query: str,
+                                *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector_docs = self._get_vector_documents(query)
+        bm25_docs = self._get_bm25_documents(query)
+        return self._rank_documents(query, vector_docs, bm25_docs)
+
+    async def _aget_relevant_documents(self,
+                                       query: str,
+                                       *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        # Run the vector and keyword searches concurrently, off the event loop
+        loop = asyncio.get_running_loop()
+        vector_docs, bm25_docs = await asyncio.gather(
+            loop.run_in_executor(None, self._get_vector_documents, query),
+            loop.run_in_executor(None, self._get_bm25_documents, query))
+        return await loop.run_in_executor(None, self._rank_documents, query, vector_docs, bm25_docs)
+
+    def _get_vector_documents(self, query: str) -> List[Document]:
+        """
+        Get the chunks closest to the query, diversified with MMR.
+        """
+        return search_chroma_chunks(analytiq_config=self.analytiq_config,
+                                    collection_name=self.collection_name,
+                                    query=query,
+                                    k=self.n_candidates if self.rerank_model else self.k,
+                                    fetch_k=self.fetch_k,
+                                    doc_types=self.doc_types,
+                                    doc_years=self.doc_years,
+                                    embedding=self.embedding)
+
+    def _rank_documents(self, query: str, vector_docs: list, bm25_docs: list) -> List[Document]:
+        """
+        Fuse the vector and keyword results, rerank them, and fit them into the token budget.
+        """
+        # Chunks found by both searches are matched on their Chroma id
+        docs = {}
+        rankings = []
+        for ranked_docs in [vector_docs, bm25_docs]:
+            ranking = []
+            for doc in ranked_docs:
+                docs.setdefault(doc.metadata["chunk_id"], doc)
+                ranking.append(doc.metadata["chunk_id"])
+            rankings.append(ranking)
+
+        n_docs = self.n_candidates if self.rerank_model else self.k
+        result_docs = [docs[key] for key in reciprocal_rank_fusion(rankings, rrf_k=self.rrf_k)[:n_docs]]
+        if self.rerank_model:
+            result_docs = rerank_documents(query,
+                                           result_docs,
+                                           model_name=self.rerank_model,
+                                           top_n=self.k,
+                                           budget_ms=self.rerank_budget_ms,
+                                           batch_size=self.rerank_batch_size)
+
+        if self.max_tokens is not None:
+            result_docs = pack_context(result_docs, self.max_tokens)
+        return result_docs
+
+    def _get_bm25_documents(self, query: str) -> List[Document]:
+        """
+        Get the chunks matching the query keywords, best first.
+        """
+        chroma_collection = get_chroma_collection(analytiq_config=self.analytiq_config,
+                                                  collection_name=self.collection_name)
+
+        # Collections uploaded before the keyword index existed are indexed on first search
+        if not check_bm25_index(self.analytiq_config, self.collection_name):
+            rebuild_bm25_index(self.analytiq_config, self.collection_name, chroma_collection)
+
+        hits = search_bm25(self.analytiq_config,
+                           self.collection_name,
+                           query,
+                           k=self.bm25_k,
+                           doc_types=self.doc_types,
+                           doc_years=self.doc_years)
+        return get_chroma_chunks(analytiq_config=self.analytiq_config,
+                                 collection_name=self.collection_name,
+                                 chunk_ids=[chunk_id for chunk_id, _ in hits])
+
+def get_hybrid_retriever(analytiq_config: dict = {},
+                         analytiq_collections: dict = {},
+                         collection_name: str = "default",
+                         search_k: int = 2,
+                         fetch_k: int = 4,
+                         doc_types: list = [],
+                         doc_years: list = []) -> AnalytiqHybridRetriever:
+    """
+    Get a retriever fusing the vector and keyword searches of a collection.
+
+    The fused retriever returns min(search_k, fetch_k) chunks, as many as the MMR vector
+    search alone, so the keyword matches compete for the same context rather than enlarging it.
+    If a rerank model is configured, the max(search_k, fetch_k) best fused chunks are reranked
+    and only the rerank_top_n most relevant are returned.
+
+    Args:
+        analytiq_config (dict, optional): The Analytiq configuration. Defaults to {}.
+        analytiq_collections (dict, optional): The collections configuration. Defaults to {}.
+        collection_name (str, optional): The name of the collection. Defaults to "default".
+        search_k (int, optional): The number of documents to search. Defaults to 2.
+        fetch_k (int, optional): The number of documents to fetch. Defaults to 4.
+        doc_types (list, optional): Only search documents of these types. Defaults to all types.
+        doc_years (list, optional): Only search documents of these years. Defaults to all years.
+
+    Returns:
+        AnalytiqHybridRetriever: The hybrid retriever.
+    """
+    embedding = "all-MiniLM-L6-v2"
+    if collection_name in analytiq_collections:
+        embedding = analytiq_collections[collection_name]["embedding"]
+
+    k = min(search_k, fetch_k)
+    retriever_kwargs = {}
+
+    # Rerank more candidates than the chain gets, and send it only the best few
+    rerank_model = analytiq_config.get("rerank_model", "")
+    if rerank_model:
+        k = analytiq_config.get("rerank_top_n", 4)
+        retriever_kwargs = {
+            "rerank_model": rerank_model,
+            "n_candidates": max(search_k, fetch_k),
+            "rerank_budget_ms": analytiq_config.get("rerank_budget_ms", 500),
+            "rerank_batch_size": analytiq_config.get("rerank_batch_size", 16)
+        }
+
+    return AnalytiqHybridRetriever(analytiq_config=analytiq_config,
+                                   collection_name=collection_name,
+                                   embedding=embedding,
+                                   k=k,
+                                   fetch_k=fetch_k,
+                                   bm25_k=max(search_k, fetch_k),
+                                   doc_types=list(doc_types),
+                                   doc_years=list(doc_years),
+                                   **retriever_kwargs)
@@ -1,31 +1,66 @@
 from dotenv import load_dotenv
 import replicate
 import time
+import threading
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
-# Initialize debounce variables
-last_call_time = 0
-debounce_interval = 2  # Set the debounce interval (in seconds) to your desired value
+class SessionRateLimiter:
+    """
+    Token bucket rate limiter, with one bucket per user session.
+
+    Each session may send burst requests at once, then one request every interval seconds.
+    """
+    def __init__(self, interval: float = 2, burst: int = 1):
+        self.interval = interval
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
 
-def debounce_replicate_run(llm, prompt, max_len, temperature, top_p, API_TOKEN):
-    global last_call_time
-    print("last call time: ", last_call_time)
+    def acquire(self, session_id: str) -> bool:
+        """
+        Take a request token from the bucket of the session.
 
-    # Get the current time
-    current_time = time.time()
+        Returns:
+            bool: True if the session may send the request, False if it is sending too fast.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last_time = self._buckets.get(session_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last_time) / self.interval)
+            if tokens < 1:
+                self._buckets[session_id] = (tokens, now)
+                return False
+            self._buckets[session_id] = (tokens - 1, now)
 
-    # Calculate the time elapsed since the last call
-    elapsed_time = current_time - last_call_time
+            # Forget the sessions whose buckets have refilled
+            if len(self._buckets) > 10000:
+                self._buckets = {sid: (t, last) for sid, (t, last) in self._buckets.items()
+                                 if now - last < self.interval * self.burst}
+            return True
 
-    # Check if the elapsed time is less than the debounce interval
-    if elapsed_time < debounce_interval:
+def get_session_id() -> str:
+    """
+    Get the id of the current Streamlit session, or "local" outside of a Streamlit script run.
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return "local"
+    return ctx.session_id
+
+# Per-session debounce of the Replicate calls
+debounce_interval = 2  # Set the debounce interval (in seconds) to your desired value
+replicate_rate_limiter = SessionRateLimiter(interval=debounce_interval, burst=1)
+
+def debounce_replicate_run(llm, prompt, max_len, temperature, top_p, API_TOKEN, session_id=None):
+    if session_id is None:
+        session_id = get_session_id()
+
+    # Check if this session sent a request less than the debounce interval ago
+    if not replicate_rate_limiter.acquire(session_id):
         print("Debouncing")
         return "Hello! You are sending requests too fast. Please wait a few seconds before sending another request."
 
-
-    # Update the last call time to the current time
-    last_call_time = time.time()
-    
     output = replicate.run(llm, input={"prompt": prompt + "Assistant: ", "max_length": max_len, "temperature": temperature, "top_p": top_p, "repetition_penalty": 1}, api_token=API_TOKEN)
     return output
 